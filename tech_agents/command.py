@@ -29,11 +29,40 @@ class Command:
         self.readonly_memory = readonly_memory
         self.chat_history = chat_history
         self.verbose = verbose
+        # コマンドから呼び出すエージェントは一度だけ構築し、実行のたびに再利用します。
+        self.search_agent = tools.SearchAgent(llm=self.llm, memory=self.memory, readonly_memory=self.readonly_memory, chat_history=self.chat_history, verbose=self.verbose)
+        self.study_agent = tools.StudyAgent(llm=self.llm, memory=self.memory, chat_history=self.chat_history, verbose=self.verbose)
+        self.procedure_agent = tools.ProcedureAgent(
+            llm=self.llm, memory=self.memory, readonly_memory=self.readonly_memory, chat_history=self.chat_history, verbose=self.verbose)
+        self.horoscope_agent = tools.HoroscopeAgent(llm=self.llm, memory=self.memory, chat_history=self.chat_history, verbose=self.verbose)
 
 
+    def get_agent(self, command: str):
+        # コマンドに対応するエージェントを返します。対応するエージェントがない場合は None を返します。
+        agents = {
+            "search": self.search_agent,
+            "study": self.study_agent,
+            "procedure": self.procedure_agent,
+            "horoscope": self.horoscope_agent,
+        }
+        return agents.get(command)
+
     def run(self, command: str, user_message: str) -> str:
-        self.user_message = user_message.replace("/" + command, "", 1)
-        
+        user_message = user_message.replace("/" + command, "", 1)
+        agent = self.get_agent(command)
+        if agent is not None:
+            return agent.run(user_message)
+        return self.reply(command)
+
+    async def arun(self, command: str, user_message: str) -> str:
+        user_message = user_message.replace("/" + command, "", 1)
+        agent = self.get_agent(command)
+        if agent is not None:
+            return await agent.arun(user_message)
+        return self.reply(command)
+
+    def reply(self, command: str) -> str:
+        # エージェントを使わずに返答するコマンドの処理
         if command == "help":
             return_text = """コマンド一覧
   ・/help : コマンド一覧を表示します。
@@ -45,23 +74,10 @@ class Command:
 以上の中から選択し、”/コマンド名+半角スペース” で実行できます。
             """
             return return_text
-        elif command == "search":
-            agent = tools.SearchAgent(llm=self.llm, memory=self.memory, readonly_memory=self.readonly_memory, chat_history=self.chat_history, verbose=self.verbose)
-            return agent.run(self.user_message)
-        elif command == "study":
-            agent = tools.StudyAgent(llm=self.llm, memory=self.memory, chat_history=self.chat_history, verbose=self.verbose)
-            return agent.run(self.user_message)
-        elif command == "procedure":
-            agent = tools.ProcedureAgent(
-                llm=self.llm, memory=self.memory, readonly_memory=self.readonly_memory, chat_history=self.chat_history, verbose=self.verbose)
-            return agent.run(self.user_message)
-        elif command == "horoscope":
-            agent = tools.HoroscopeAgent(llm=self.llm, memory=self.memory, chat_history=self.chat_history, verbose=self.verbose)
-            return agent.run(self.user_message)
         else:
             return_text = """{{ command }} というコマンドは見つかりませんでした。
 コマンドは ”/コマンド名+半角スペース” で実行できます。
 コマンド名がわからない場合は /help でコマンド一覧を確認できます。
 """
             return_text = return_text.format(command=command)
-            return return_text
\ No newline at end of file
+            return return_text
@@ -1,12 +1,13 @@
 from langchain.agents import Tool
 
 from tech_agents.template.agent_model import BaseDispatcherAgent
+from tech_agents.template.pre_router import RouteRule
 from tech_agents import tools
 
 
 class MainDispatcherAgent(BaseDispatcherAgent):
-    def __init__(self, llm, memory, readonly_memory, chat_history, verbose):
-        super().__init__(llm, memory, readonly_memory, chat_history, verbose)
+    def __init__(self, llm, memory, readonly_memory, chat_history, verbose, flatten=False):
+        super().__init__(llm, memory, readonly_memory, chat_history, verbose, flatten)
     
     def define_tools(self):
         self.search_agent = tools.SearchAgent(
@@ -25,6 +26,7 @@ class MainDispatcherAgent(BaseDispatcherAgent):
         main_dispatcher_tools = [
             Tool.from_function(
                 func=self.search_agent.run,
+                coroutine=self.search_agent.arun,
                 name="search",
                 # description="この担当者は検索や質問に答える担当者。技術的な質問や、学校についての質問、奨学金についての疑問などを解決する場合はこの担当者に任せる。",
                 description="This person is in charge of searching and answering questions. If you have a technical question, a question about the school, or a question about scholarships, this is the person to contact.",
@@ -33,6 +35,7 @@ class MainDispatcherAgent(BaseDispatcherAgent):
             ),
             Tool.from_function(
                 func=self.procedure_agent.run,
+                coroutine=self.procedure_agent.arun,
                 name="procedure",
                 # description="この担当者は各種手続きに関する担当者。公欠届や遅延届などの手続きに関する会話の対応はこの担当者に任せる。",
                 description="This person is in charge of various procedures. This person is in charge of handling conversations regarding procedures such as public absence reports and late reports.",
@@ -41,6 +44,7 @@ class MainDispatcherAgent(BaseDispatcherAgent):
             ),
             Tool.from_function(
                 func=self.horoscope_agent.run, # ラッパー関数を指定, ここで定義した関数が実行される
+                coroutine=self.horoscope_agent.arun,
                 name="horoscope", # ツールの名前を指定, この名前がディスパッチャーエージェントの出力になる, この名前が出力された際にfuncで指定した関数が実行される
                 # description="この担当者は星占いのできる担当者。星占いがしたい時はこの担当者に任せる。", # ツールの説明を指定, この説明をもとにディスパッチャーエージェントはユーザーに対して適切なツールを選択する
                 description="This person in charge is the person in charge who can do horoscopes. When you want to do horoscopes, leave it to this person in charge.", # ツールの説明を指定, この説明をもとにディスパッチャーエージェントはユーザーに対して適切なツールを選択する
@@ -49,6 +53,7 @@ class MainDispatcherAgent(BaseDispatcherAgent):
             ),
             Tool.from_function(
                 func=self.study_agent.run,
+                coroutine=self.study_agent.arun,
                 name="study",
                 # description="この担当者は授業の勉強をお手伝いする担当者。授業の勉強についての会話の対応はこの担当者に任せる。",
                 description="This person is in charge of helping you study for your classes. This person is in charge of handling conversations about studying for your classes.",
@@ -57,6 +62,7 @@ class MainDispatcherAgent(BaseDispatcherAgent):
             ),
             Tool.from_function(
                 func=self.translate_agent.run,
+                coroutine=self.translate_agent.arun,
                 name="translate",
                 # description="この担当者は翻訳をする担当者。翻訳が必要な時はこの担当者に任せる。",
                 description="This person is in charge of translating. When you need a translation, leave it to this person.",
@@ -65,6 +71,7 @@ class MainDispatcherAgent(BaseDispatcherAgent):
             ),
             Tool.from_function(
                 func=self.default_agent.run,
+                coroutine=self.default_agent.arun,
                 name="DEFAULT",
                 # description="この担当者は専門的な会話ではない場合に任せる担当者。",
                 description="This person is the person to leave in charge when the conversation is not a professional one.",
@@ -74,3 +81,15 @@ class MainDispatcherAgent(BaseDispatcherAgent):
         ]
         
         return main_dispatcher_tools
+
+    def define_routes(self):
+        # LLM を使わずに振り分けるキーワードの定義
+        return [
+            RouteRule("procedure", keywords=["公欠", "遅延届", "遅延証明", "欠席届", "申請したい", "手続き"]),
+            RouteRule("horoscope", keywords=["占い", "占って", "星座", "運勢", "horoscope"]),
+            RouteRule("translate", keywords=["翻訳", "英訳", "和訳", "訳して", "translate"]),
+            RouteRule("study", keywords=["問題を出して", "問題を作って", "小テスト", "勉強", "復習"]),
+            RouteRule("search", keywords=["奨学金", "シラバス", "検索", "調べて", "京都テック", "学科", "専攻"]),
+            # 挨拶のみの発言は確実に DEFAULT に振り分ける
+            RouteRule("DEFAULT", patterns=[r"^(こんにちは|こんばんは|おはよう(ございます)?|ありがとう(ございます)?|hello|hi)[!！。、\s]*$"], weight=2.0),
+        ]
@@ -1,3 +1,8 @@
+import asyncio
+import queue
+import threading
+from typing import AsyncIterator, Iterator
+
 import langchain
 from langchain_openai import AzureChatOpenAI
 from langchain.memory import ConversationBufferMemory, ReadOnlySharedMemory
@@ -6,6 +11,8 @@ from langchain.prompts.chat import MessagesPlaceholder
 from tech_agents.command import Command, check_command
 from tech_agents.dispatcher import MainDispatcherAgent
 from tech_agents.template import default_value
+from tech_agents.template.memory import SessionMemoryStore, TurnMemory, use_memory
+from tech_agents.template.streaming import StreamEvent, streaming_llm, use_stream
 
 
 class MainAgent:
@@ -18,6 +25,7 @@ class MainAgent:
     MainAgentクラスは、メインのエージェントを表すクラスです。
     このクラスは、AzureChatOpenAI、ConversationBufferMemory、MessagesPlaceholderなどの属性を持ちます。
     メインエージェントは、指定された入力に対してAgentクラスを実行します。
+    エージェントツリーはインスタンス化時に一度だけ構築され、run の呼び出しをまたいで再利用されます。
     """
 
     def __init__(
@@ -26,6 +34,8 @@ class MainAgent:
         memory: ConversationBufferMemory = default_value.default_memory,
         chat_history: MessagesPlaceholder = default_value.default_chat_history,
         verbose: bool = False,
+        memory_store: SessionMemoryStore = None,
+        flatten_routing: bool = False,
     ):
         """
         MainAgentクラスのコンストラクタです。
@@ -37,7 +47,9 @@ class MainAgent:
             llm=あなたの使用したいLLM,
             memory=あなたの使用したいメモリ,
             chat_history=あなたの使用したい会話履歴,
-            verbose=デバッグモードを有効にするかどうか
+            verbose=デバッグモードを有効にするかどうか,
+            memory_store=セッションごとのメモリを保持するストア,
+            flatten_routing=検索や手続きの担当者まで1回のルーター呼び出しで振り分けるかどうか
         )
         
         実行
@@ -45,6 +57,17 @@ class MainAgent:
         message = "こんにちは"
         output = main_agent.run(message)
         print(output)
+
+        複数のユーザーと会話する場合は、セッションIDを指定して実行します。
+        output = main_agent.run(message, session_id="user-1")
+
+        非同期に実行する場合は arun を使用します。
+        output = await main_agent.arun(message, session_id="user-1")
+
+        回答をトークンごとに受け取る場合は stream (非同期の場合は astream) を使用します。
+        for event in main_agent.stream(message, session_id="user-1"):
+            if event.type == "token":
+                print(event.data, end="")
         
         """
 
@@ -53,34 +76,170 @@ class MainAgent:
         self.memory = memory
         self.chat_history = chat_history
         self.verbose = verbose
+        self.flatten_routing = flatten_routing
+        self.memory_store = memory_store or SessionMemoryStore()
 
         # メモリの読み取り専用化
         self.readonly_memory = ReadOnlySharedMemory(memory=self.memory)
+        # セッションIDを指定しない場合に使用するターンのメモリ
+        self.default_turn = TurnMemory(self.memory, self.readonly_memory)
         # デバッグモードの設定
         langchain.debug = self.verbose
 
-    def run(self, user_message: str) -> str:
-        """
-        メインエージェントを実行するメソッドです。
-        Agentクラスを生成し、指定された入力を渡して実行します。
-        """
-
-        param = check_command(user_message)
-        if param.check_command_bool:
-            CommandAgent = Command(
-                llm=self.llm,
-                memory=self.memory,
-                readonly_memory=self.readonly_memory,
-                chat_history=self.chat_history,
-                verbose=self.verbose
-            )
-            return CommandAgent.run(param.command, user_message)
-        
-        main_agent = MainDispatcherAgent(
+        # エージェントツリーの構築
+        # ツリーはメモリに依存しないため一度だけ構築し、ターンごとのメモリは実行時に渡します。
+        self.command = Command(
             llm=self.llm,
             memory=self.memory,
             readonly_memory=self.readonly_memory,
             chat_history=self.chat_history,
             verbose=self.verbose
         )
-        return main_agent.run(user_message)
+        self.dispatcher_agent = MainDispatcherAgent(
+            llm=self.llm,
+            memory=self.memory,
+            readonly_memory=self.readonly_memory,
+            chat_history=self.chat_history,
+            verbose=self.verbose,
+            flatten=self.flatten_routing
+        )
+        # ストリーミング用のエージェントツリーは、stream の初回の呼び出し時に構築します。
+        self.streaming_command = None
+        self.streaming_dispatcher_agent = None
+        self._streaming_lock = threading.Lock()
+
+    def get_turn(self, session_id: str = None) -> TurnMemory:
+        # セッションIDに対応するメモリを返します。セッションIDが None の場合はインスタンス化時のメモリを返します。
+        if session_id is None:
+            return self.default_turn
+        return self.memory_store.get(session_id)
+
+    def router_stats(self) -> dict:
+        # 事前ルーターの統計 (LLM を使わずに振り分けた割合など) を、ディスパッチャーのパスごとに返します。
+        return self.dispatcher_agent.router_stats()
+
+    def create_streaming_agents(self):
+        # トークンをストリームへ配信する LLM で、エージェントツリーをもう1つ構築します。
+        with self._streaming_lock:
+            if self.streaming_dispatcher_agent is None:
+                llm = streaming_llm(self.llm)
+                self.streaming_command = Command(
+                    llm=llm,
+                    memory=self.memory,
+                    readonly_memory=self.readonly_memory,
+                    chat_history=self.chat_history,
+                    verbose=self.verbose
+                )
+                self.streaming_dispatcher_agent = MainDispatcherAgent(
+                    llm=llm,
+                    memory=self.memory,
+                    readonly_memory=self.readonly_memory,
+                    chat_history=self.chat_history,
+                    verbose=self.verbose,
+                    flatten=self.flatten_routing
+                )
+        return self.streaming_command, self.streaming_dispatcher_agent
+
+    def run(self, user_message: str, *, session_id: str = None) -> str:
+        """
+        メインエージェントを実行するメソッドです。
+        構築済みのエージェントツリーに、指定された入力を渡して実行します。
+        会話履歴は session_id ごとに memory_store で管理されます。session_id はキーワード引数で指定します (run(message, session_id="user-1"))。
+        session_id を省略した場合は、インスタンス化時に指定したメモリを使用します。
+        """
+        return self.run_agents(self.command, self.dispatcher_agent, session_id, user_message)
+
+    async def arun(self, user_message: str, *, session_id: str = None) -> str:
+        """
+        メインエージェントを非同期に実行するメソッドです。
+        引数は run と同じです。LLM の呼び出しや検索を待つ間、イベントループは他のセッションの処理を進めることができます。
+        """
+        return await self.arun_agents(self.command, self.dispatcher_agent, session_id, user_message)
+
+    def stream(self, user_message: str, *, session_id: str = None) -> Iterator[StreamEvent]:
+        """
+        メインエージェントを実行し、StreamEvent を順に返すジェネレーターです。
+        振り分け先が決まるたびに route イベント、回答のトークンごとに token イベントを返し、最後に回答全体の final イベントを返します。
+        引数は run と同じです。
+        """
+        command, dispatcher_agent = self.create_streaming_agents()
+        events: queue.Queue = queue.Queue()
+        result = {}
+
+        def worker():
+            try:
+                with use_stream(events.put):
+                    result["output"] = self.run_agents(command, dispatcher_agent, session_id, user_message)
+            except BaseException as e:
+                result["error"] = e
+            finally:
+                events.put(None)
+
+        threading.Thread(target=worker, daemon=True).start()
+        streamed = False
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            streamed = streamed or event.type == "token"
+            yield event
+        if "error" in result:
+            raise result["error"]
+        yield from self.finish_stream(result["output"], streamed)
+
+    async def astream(self, user_message: str, *, session_id: str = None) -> AsyncIterator[StreamEvent]:
+        """
+        stream の非同期版です。
+        """
+        command, dispatcher_agent = self.create_streaming_agents()
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+
+        def sink(event):
+            # エグゼキューターのスレッドで実行されるツールからも呼び出されるため、イベントループを経由してキューに入れます。
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        async def produce():
+            try:
+                with use_stream(sink):
+                    return await self.arun_agents(command, dispatcher_agent, session_id, user_message)
+            finally:
+                sink(None)
+
+        task = asyncio.create_task(produce())
+        try:
+            streamed = False
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                streamed = streamed or event.type == "token"
+                yield event
+            output = await task
+        finally:
+            if not task.done():
+                task.cancel()
+        for event in self.finish_stream(output, streamed):
+            yield event
+
+    def finish_stream(self, output: str, streamed: bool) -> Iterator[StreamEvent]:
+        # return_direct のツールの出力など、トークンが配信されなかった回答は、そのまま1つのトークンとして配信します。
+        if not streamed:
+            yield StreamEvent("token", output)
+        yield StreamEvent("final", output)
+
+    def run_agents(self, command: Command, dispatcher_agent: MainDispatcherAgent, session_id: str, user_message: str) -> str:
+        with use_memory(self.get_turn(session_id)):
+            param = check_command(user_message)
+            if param.check_command_bool:
+                return command.run(param.command, user_message)
+
+            return dispatcher_agent.run(user_message)
+
+    async def arun_agents(self, command: Command, dispatcher_agent: MainDispatcherAgent, session_id: str, user_message: str) -> str:
+        with use_memory(self.get_turn(session_id)):
+            param = check_command(user_message)
+            if param.check_command_bool:
+                return await command.arun(param.command, user_message)
+
+            return await dispatcher_agent.arun(user_message)
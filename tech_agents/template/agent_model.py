@@ -13,9 +13,14 @@ from langchain.schema import (
 from langchain.prompts import PromptTemplate
 from langchain.prompts.chat import MessagesPlaceholder, SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate
 from pydantic.v1 import Extra
-from typing import Any, List, Tuple, Set, Union
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple, Set, Union
 
 from tech_agents.template import default_value
+from tech_agents.template.memory import HistoryBudget, TurnMemory, current_dialog, load_history, resolve_memory, use_memory
+from tech_agents.template.pre_router import PreRouter, RouteRule
+from tech_agents.template.streaming import ROUTER_TAG, StreamEvent, emit_event
 
 
 # プロンプトの定義
@@ -60,6 +65,25 @@ Note: The output must always be one of the names listed as choices. However, if
 
 
 
+class _IdentityKey:
+    """
+    オブジェクトの同一性 (is) で比較するキャッシュのキーです。
+    LLM やツールの pydantic のモデルはハッシュできないため、このキーで包んで使用します。
+    オブジェクトへの参照を保持するため、キャッシュにある間にオブジェクトが破棄されて id が再利用されることはありません。
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __hash__(self) -> int:
+        return id(self.obj)
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, _IdentityKey) and other.obj is self.obj
+
+
 class DestinationOutputParser(BaseOutputParser[str]):
     """
     このクラスは、ルーターチェーンの出力を解析して目的地を決定するための出力パーサーです。
@@ -79,16 +103,18 @@ class DestinationOutputParser(BaseOutputParser[str]):
 
     def parse(self, text: str) -> str:
         # 入力テキストが各目的地に含まれるかどうかをチェックします。
-        matched = [int(d in text) for d in self.destinations_and_default]
+        matched = [d for d in self.destinations_and_default if d in text]
+        # 他の目的地の名前の一部として含まれているだけの目的地は除外します。(例: "search.DEFAULT" に含まれる "DEFAULT")
+        matched = [d for d in matched if not any(d != other and d in other for other in matched)]
         # マッチした目的地が1つだけでなければ、例外をスローします。
-        if sum(matched) != 1:
+        if len(matched) != 1:
             raise OutputParserException(
                 f"DestinationOutputParser expected output value includes "
                 f"one(and only one) of {self.destinations_and_default}. "
                 f"Received {text}."
             )
         # マッチした目的地を返します。
-        return self.destinations_and_default[matched.index(1)]
+        return matched[0]
 
     @property
     def _type(self) -> str:
@@ -104,6 +130,12 @@ class DispatcherAgent(BaseSingleActionAgent):
     readonly_memory: ReadOnlySharedMemory
     tools: List[Tool]
     verbose: bool = False
+    # ルーターに渡す会話履歴の上限 (HistoryBudget)。None の場合は全ての履歴を渡します。
+    history_budget: Any = None
+    # LLM を使わずに振り分ける事前ルーター (PreRouter)。None の場合は常に LLM で振り分けます。
+    pre_router: Any = None
+    # 手続きの名前 -> 手続きの実行中に振り分けるツールの名前
+    sticky_routes: Dict[str, str] = {}
 
     class Config:
         # 追加の設定を許可します。
@@ -112,6 +144,11 @@ class DispatcherAgent(BaseSingleActionAgent):
     def __init__(self, **kwargs):
         # 親クラスの初期化メソッドを呼び出します。
         super().__init__(**kwargs)
+        # 事前ルーターの振り分け先がツールに含まれているかを確認します。
+        if self.pre_router is not None:
+            unknown = self.pre_router.destinations - set([tool.name for tool in self.tools] + ["DEFAULT"])
+            if unknown:
+                raise ValueError(f"PreRouter has destinations that are not tools: {sorted(unknown)}")
         # ツールのリストから各ツールの名前と説明を取得し、それらを改行で結合した文字列を作成します。
         destinations = "\n".join(
             [f"{tool.name}: {tool.description}" for tool in self.tools])
@@ -128,10 +165,10 @@ class DispatcherAgent(BaseSingleActionAgent):
                 template=ROUTER_PROMPT_SUFFIX)
         ])
         # ルーターチェーンを作成します。
+        # 会話履歴はターンごとに異なるため、メモリはチェーンに持たせず実行時に読み込みます。
         self.router_chain = LLMChain(
             llm=self.chat_model,
             prompt=router_prompt_template,
-            memory=self.readonly_memory,
             verbose=self.verbose
         )
         # ルートパーサーを作成します。
@@ -144,29 +181,65 @@ class DispatcherAgent(BaseSingleActionAgent):
         # 入力キーを返します。
         return ["input"]
 
-    def plan(
-        self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any
-    ) -> Union[AgentAction, AgentFinish]:
-        # ルーターチェーンを実行し、その出力を解析して目的地を決定します。
-        router_output = self.router_chain.run(kwargs["input"])
+    def load_history(self) -> dict:
+        # 実行中のターンの会話履歴を、上限に収めて読み込みます。
+        return load_history(resolve_memory(self.readonly_memory), self.history_budget)
+
+    def sticky_route(self, user_message: str) -> Optional[str]:
+        """
+        手続きの実行中であれば、その手続きの担当者へ振り分けるツールの名前を返します。
+        「はい」「2限」のような手続きへの回答は事前ルーターで予測できないため、LLM のルーターも使わずにそのまま担当者へ振り分けます。
+        手続きが終わるのは、担当のツールが完了・キャンセルした場合、max_turns ターン続いた場合、
+        または事前ルーターが別の振り分け先を確信できるほど話題が変わった場合 (手続きを終了して None を返します) だけです。
+        """
+        dialog = current_dialog()
+        if dialog is None or not dialog.is_active:
+            return None
+        destination = self.sticky_routes.get(dialog.active_procedure)
+        if destination is None:
+            return None
+        if self.pre_router is not None:
+            predicted = self.pre_router.predict(user_message)
+            if predicted is not None and predicted != destination:
+                dialog.end()
+                return None
+        return destination
+
+    def pre_route(self, user_message: str) -> Optional[str]:
+        # 事前ルーターで振り分け先が決まる場合は、その振り分け先を返します。
+        if self.pre_router is None:
+            return None
+        return self.pre_router.route(user_message)
+
+    def parse_route(self, router_output: str) -> str:
         try:
-            destination = self.route_parser.parse(router_output)
+            return self.route_parser.parse(router_output)
         except OutputParserException as ope:
             # 出力が解析できない場合、デフォルトの目的地が選択されます。
-            destination = "DEFAULT"
+            return "DEFAULT"
+
+    def plan(
+        self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any
+    ) -> Union[AgentAction, AgentFinish]:
+        # 手続きの実行中でなく、事前ルーターでも決まらない場合のみ、ルーターチェーンを実行し、その出力を解析して目的地を決定します。
+        destination = self.sticky_route(kwargs["input"]) or self.pre_route(kwargs["input"])
+        if destination is None:
+            # ルーターの出力は回答ではないため、ストリーミング時にトークンを配信しないようにタグを付けます。
+            router_output = self.router_chain.run(input=kwargs["input"], tags=[ROUTER_TAG], **self.load_history())
+            destination = self.parse_route(router_output)
+        emit_event(StreamEvent("route", destination))
         # 選択されたツールと入力、および空のログを含む`AgentAction`オブジェクトを返します。
         return AgentAction(tool=destination, tool_input=kwargs["input"], log="")
 
     async def aplan(
         self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any
     ) -> Union[AgentAction, AgentFinish]:
-        # ルーターチェーンを非同期に実行し、その出力を解析して目的地を決定します。
-        router_output = await self.router_chain.arun(kwargs["input"])
-        try:
-            destination = self.route_parser.parse(router_output)
-        except OutputParserException as ope:
-            # 出力が解析できない場合、デフォルトの目的地が選択されます。
-            destination = "DEFAULT"
+        # 手続きの実行中でなく、事前ルーターでも決まらない場合のみ、ルーターチェーンを非同期に実行し、その出力を解析して目的地を決定します。
+        destination = self.sticky_route(kwargs["input"]) or self.pre_route(kwargs["input"])
+        if destination is None:
+            router_output = await self.router_chain.arun(input=kwargs["input"], tags=[ROUTER_TAG], **self.load_history())
+            destination = self.parse_route(router_output)
+        emit_event(StreamEvent("route", destination))
         # 選択されたツールと入力、および空のログを含む`AgentAction`オブジェクトを返します。
         return AgentAction(tool=destination, tool_input=kwargs["input"], log="")
 
@@ -196,6 +269,7 @@ class BaseDispatcherAgent:
             tools = [
                 Tool.from_function(
                     func=tool_1.run, # ツールの実行関数
+                    coroutine=tool_1.arun, # ツールの非同期の実行関数 (arun で使用)
                     name="tool_1", # ツールの名前
                     description="tool_1の説明"
                     args_schema=tool_1_input_schema, # ツールの入力スキーマ
@@ -213,7 +287,21 @@ class BaseDispatcherAgent:
             return tools
     ```
     3. run メソッドで、ツールの実行を行う。
+
+    ツールとルーターはインスタンス化時に一度だけ構築され、run の呼び出しをまたいで再利用されます。
+    ターンごとに異なるメモリは run の引数 turn、または use_memory で渡してください。
+    ルーターに渡す会話履歴の上限は history_budget で変更できます。
+
+    define_routes メソッドでキーワードのルールを定義すると、確信度の高い入力は LLM を呼び出さずに振り分けます。
+    確信度のしきい値は pre_router_min_score と pre_router_min_margin で変更できます。
+
+    flatten=True を指定すると、下位のディスパッチャーのツールを "search.school_agent" のような階層的な名前で展開し、
+    1回のルーター呼び出しで末端のツールまで振り分けます。(ルーターの LLM 呼び出しが1回で済みます)
     """
+    history_budget: HistoryBudget = default_value.default_router_history_budget
+    pre_router_min_score: float = 1.0
+    pre_router_min_margin: float = 1.0
+
     def __init__(
         self, 
         llm: AzureChatOpenAI = default_value.default_llm,
@@ -221,6 +309,7 @@ class BaseDispatcherAgent:
         readonly_memory: ReadOnlySharedMemory = default_value.default_readonly_memory,
         chat_history: MessagesPlaceholder = default_value.default_chat_history,
         verbose: bool = False,
+        flatten: bool = False,
         ):
         """
         このクラスは、ユーザーの入力を受け取り、適切なツールを選択して実行するディスパッチャーエージェントの基底クラスです。
@@ -230,8 +319,14 @@ class BaseDispatcherAgent:
         self.readonly_memory = readonly_memory
         self.chat_history = chat_history
         self.verbose = verbose
-        self.tools = self.define_tools()
+        self.flatten = flatten
+        # define_tools で定義したツールと、ルーターが振り分けるツール (flatten=True の場合は末端のツール)
+        self.defined_tools = self.define_tools()
+        self.tools = self.leaf_tools() if self.flatten else self.defined_tools
+        self.pre_router = self.create_pre_router()
+        self.sticky_routes = self.create_sticky_routes()
         self.dispatcher_agent = self.create_dispatcher_agent()
+        self.agent_executor = self.create_agent_executor()
 
     def define_tools(self) -> List[Tool]:
         """
@@ -245,15 +340,112 @@ class BaseDispatcherAgent:
         # ツールの定義をサブクラスで実装
         raise NotImplementedError("This method should be implemented by subclasses.")
 
+    def define_routes(self) -> List[RouteRule]:
+        """
+        このメソッドは、事前ルーターのルールの定義を行います。
+        ルールを定義しない場合は、常に LLM のルーターで振り分けます。
+        --------------------
+        実装方法:
+        ```
+        def define_routes(self) -> List[RouteRule]:
+            return [
+                RouteRule("tool_1", keywords=["キーワード1", "キーワード2"]),
+                RouteRule("tool_2", patterns=[r"正規表現"]),
+            ]
+        ```
+        """
+        return []
+
+    def create_pre_router(self) -> Optional[PreRouter]:
+        rules = self.leaf_routes() if self.flatten else self.define_routes()
+        if not rules:
+            return None
+        return PreRouter(rules, min_score=self.pre_router_min_score, min_margin=self.pre_router_min_margin)
+
     def create_dispatcher_agent(self) -> DispatcherAgent:
         return DispatcherAgent(
             chat_model=self.llm,
             readonly_memory=self.readonly_memory,
             tools=self.tools,
-            verbose=self.verbose
+            verbose=self.verbose,
+            history_budget=self.history_budget,
+            pre_router=self.pre_router,
+            sticky_routes=self.sticky_routes
+        )
+
+    def create_sticky_routes(self) -> Dict[str, str]:
+        """
+        手続きの名前と、手続きの実行中に振り分けるツールの名前の対応を作成します。
+        procedure_name を持つツールエージェントと、それを含む下位のディスパッチャーが対象です。
+        """
+        sticky_routes = {}
+        for tool in self.tools:
+            owner = getattr(tool.func, "__self__", None)
+            if isinstance(owner, BaseDispatcherAgent):
+                sticky_routes.update({procedure: tool.name for procedure in owner.sticky_routes})
+            elif isinstance(owner, BaseToolAgent) and owner.procedure_name:
+                sticky_routes[owner.procedure_name] = tool.name
+        return sticky_routes
+
+    def nested_dispatchers(self) -> Dict[str, "BaseDispatcherAgent"]:
+        # ツールとして登録されている下位のディスパッチャーエージェントを、ツール名をキーにして返します。
+        return {
+            tool.name: tool.func.__self__
+            for tool in self.defined_tools
+            if isinstance(getattr(tool.func, "__self__", None), BaseDispatcherAgent)
+        }
+
+    def leaf_tools(self) -> List[Tool]:
+        """
+        下位のディスパッチャーを展開した末端のツールのリストを返します。
+        展開したツールの名前は "上位のツール名.末端のツール名"、説明は "上位の説明 > 末端の説明" になります。
+        """
+        nested = self.nested_dispatchers()
+        leaves = []
+        for tool in self.defined_tools:
+            dispatcher = nested.get(tool.name)
+            if dispatcher is None:
+                leaves.append(tool)
+                continue
+            for leaf in dispatcher.leaf_tools():
+                leaves.append(Tool(
+                    name=f"{tool.name}.{leaf.name}",
+                    description=f"{tool.description} > {leaf.description}",
+                    func=leaf.func,
+                    coroutine=leaf.coroutine,
+                    args_schema=leaf.args_schema,
+                    return_direct=leaf.return_direct
+                ))
+        return leaves
+
+    def leaf_routes(self) -> List[RouteRule]:
+        # 事前ルーターのルールを、leaf_tools の名前に合わせて展開して返します。
+        nested = self.nested_dispatchers()
+        rules = [rule for rule in self.define_routes() if rule.destination not in nested]
+        for name, dispatcher in nested.items():
+            rules += [rule.renamed(f"{name}.{rule.destination}") for rule in dispatcher.leaf_routes()]
+        return rules
+
+    def router_stats(self) -> Dict[str, dict]:
+        """
+        このディスパッチャーと下位のディスパッチャーの事前ルーターの統計を返します。
+        キーはルートからのツール名を "/" で繋いだパスで、このディスパッチャー自身は "" です。
+        """
+        stats = {}
+        if self.pre_router is not None:
+            stats[""] = self.pre_router.stats.as_dict()
+        for name, dispatcher in self.nested_dispatchers().items():
+            for path, value in dispatcher.router_stats().items():
+                stats[f"{name}/{path}" if path else name] = value
+        return stats
+
+    def create_agent_executor(self) -> AgentExecutor:
+        # メモリはターンごとに異なるため、エグゼキューターには持たせず run の中で保存します。
+        return AgentExecutor.from_agent_and_tools(
+            agent=self.dispatcher_agent, tools=self.tools, verbose=self.verbose
         )
 
-    def run(self, user_message: str) -> str:
+    def run(self, user_message: str, turn: TurnMemory = None) -> str:
         """
         `DispatcherAgent`の実行メソッドです。
         --------------------
@@ -261,15 +453,30 @@ class BaseDispatcherAgent:
         ```
         return_message: str = dispatcher_agent.run(user_message: str) 
         ```
+        turn を指定した場合は、そのターンのメモリを使用して実行します。
         """
         # 共通の run メソッド
+        if turn is not None:
+            with use_memory(turn):
+                return self.run(user_message)
         try:
-            agent = AgentExecutor.from_agent_and_tools(
-                agent=self.dispatcher_agent, tools=self.tools, memory=self.memory, verbose=self.verbose
-            )
-            return agent.run(user_message)
+            output = self.agent_executor.run(user_message)
         except Exception as e:
             raise e
+        resolve_memory(self.memory).save_context({"input": user_message}, {"output": output})
+        return output
+
+    async def arun(self, user_message: str, turn: TurnMemory = None) -> str:
+        """
+        `DispatcherAgent`の非同期の実行メソッドです。
+        ツールに coroutine が指定されている場合は、ツールも非同期に実行されます。
+        """
+        if turn is not None:
+            with use_memory(turn):
+                return await self.arun(user_message)
+        output = await self.agent_executor.arun(user_message)
+        resolve_memory(self.memory).save_context({"input": user_message}, {"output": output})
+        return output
 
 
 
@@ -285,11 +492,30 @@ class BaseToolAgent:
         def __init__(self, llm, memory, chat_history, verbose):
             super().__init__(llm, memory, chat_history, verbose)
             
-        def run(self, input) -> str:
-            ...
-            return agent.run(input)
+        def get_agent(self) -> AgentExecutor:
+            return self.initialize_agent(...)
     ```
+    2. run (または非同期の arun) メソッドで、get_agent で取得したエージェントを実行する。
+
+    initialize_agent で作成した AgentExecutor は (エージェントクラス, エージェントタイプ, ツール, システムプロンプト, LLM) ごとにキャッシュされ、
+    2回目以降の run ではエージェントの構築を行いません。キャッシュは最大 agent_cache_max_size 件で、最も長く使われていないものから削除します。
+    会話履歴はキャッシュしたエグゼキューターには持たせず、run_agent の実行時にターンのメモリから渡します。
+    プロンプトやツールを差し替えた場合は invalidate_agent_cache でキャッシュを破棄してください。
+    エージェントに渡す会話履歴の上限は history_budget で変更できます。
+
+    複数ターンにわたる手続きを行うエージェントは procedure_name を設定してください。
+    手続きの実行中はディスパッチャーがルーターを通さずにこのエージェントへ振り分け、
+    会話履歴は手続きを開始する直前のターンからの全ての履歴を渡します。
+    手続きはツールから end_procedure を呼び出して終了します。
     """
+    history_budget: HistoryBudget = default_value.default_tool_history_budget
+    procedure_name: Optional[str] = None
+
+    # 構築済みの AgentExecutor のキャッシュ (全サブクラスで共有、最も長く使われていないものから削除)
+    agent_cache_max_size: int = 64
+    _agent_cache: "OrderedDict[tuple, AgentExecutor]" = OrderedDict()
+    _agent_cache_lock = Lock()
+
     def __init__(
         self,
         llm: AzureChatOpenAI = default_value.default_llm,
@@ -315,27 +541,109 @@ class BaseToolAgent:
         self.verbose = verbose
         langchain.debug = self.verbose
 
-    def run(self, input) -> str:
+    def get_agent(self) -> AgentExecutor:
+        # エージェントの取得をサブクラスで実装
         raise NotImplementedError(
             "This method should be implemented by subclasses.")
 
+    def run(self, input) -> str:
+        return self.run_agent(self.get_agent(), input)
+
+    async def arun(self, input) -> str:
+        return await self.arun_agent(self.get_agent(), input)
+
     def initialize_agent(
         self,
         agent_type: AgentType,
         tools: List,
         system_message_template: str
-        ) -> initialize_agent:
-        # エージェントの初期化
-        agent_kwargs = {
-            "system_message": SystemMessagePromptTemplate.from_template(template=system_message_template),
-            "extra_prompt_messages": [self.chat_history]
-        }
-        agent_function = initialize_agent(
-            tools=tools,
-            llm=self.llm,
-            agent=agent_type,
-            verbose=self.verbose,
-            agent_kwargs=agent_kwargs,
-            memory=self.memory
-        )
+        ) -> AgentExecutor:
+        # 構築済みのエージェントがあれば再利用する
+        key = self.agent_cache_key(agent_type, tools, system_message_template)
+        with self._agent_cache_lock:
+            agent_function = self._agent_cache.get(key)
+            if agent_function is not None:
+                self._agent_cache.move_to_end(key)
+            else:
+                # エージェントの初期化
+                agent_kwargs = {
+                    "system_message": SystemMessagePromptTemplate.from_template(template=system_message_template),
+                    "extra_prompt_messages": [self.chat_history]
+                }
+                agent_function = initialize_agent(
+                    tools=tools,
+                    llm=self.llm,
+                    agent=agent_type,
+                    verbose=self.verbose,
+                    agent_kwargs=agent_kwargs
+                )
+                self._agent_cache[key] = agent_function
+                while len(self._agent_cache) > self.agent_cache_max_size:
+                    self._agent_cache.popitem(last=False)
         return agent_function
+
+    def agent_cache_key(
+        self,
+        agent_type: AgentType,
+        tools: List,
+        system_message_template: str
+        ) -> tuple:
+        # キャッシュのキーを作成する
+        # ツールとLLMはモジュールやインスタンス単位で共有されるため、オブジェクトの同一性で区別する
+        return (
+            type(self),
+            agent_type,
+            tuple((tool.name, _IdentityKey(tool)) for tool in tools),
+            system_message_template,
+            _IdentityKey(self.llm),
+            _IdentityKey(self.chat_history),
+            self.verbose,
+        )
+
+    def run_agent(self, agent: AgentExecutor, input: str) -> str:
+        # ターンのメモリから会話履歴を読み込んでエージェントを実行し、結果をメモリに保存する
+        inputs = self.prepare_inputs(input)
+        output = agent.invoke(inputs)["output"]
+        return self.finish_turn(input, output)
+
+    async def arun_agent(self, agent: AgentExecutor, input: str) -> str:
+        # run_agent の非同期版
+        inputs = self.prepare_inputs(input)
+        output = (await agent.ainvoke(inputs))["output"]
+        return self.finish_turn(input, output)
+
+    def prepare_inputs(self, input: str) -> dict:
+        # 手続きを開始し、エージェントへの入力に会話履歴を加える
+        dialog = current_dialog()
+        if self.procedure_name and dialog is not None:
+            dialog.begin(self.procedure_name)
+        memory = resolve_memory(self.memory)
+        return {"input": input, **load_history(memory, self.turn_history_budget())}
+
+    def finish_turn(self, input: str, output: str) -> str:
+        # 結果をメモリに保存し、手続きのターンを進める
+        resolve_memory(self.memory).save_context({"input": input}, {"output": output})
+        dialog = current_dialog()
+        if self.procedure_name and dialog is not None:
+            dialog.advance(self.procedure_name)
+        return output
+
+    def turn_history_budget(self) -> Optional[HistoryBudget]:
+        # 手続きの実行中は、手続きを開始する直前のターンからの履歴を渡す
+        dialog = current_dialog()
+        if self.procedure_name and dialog is not None and dialog.active_procedure == self.procedure_name:
+            return HistoryBudget(max_turns=dialog.turns + 1)
+        return self.history_budget
+
+    @classmethod
+    def invalidate_agent_cache(cls) -> None:
+        """
+        キャッシュした AgentExecutor を破棄します。
+        BaseToolAgent から呼び出した場合は全てのキャッシュを、サブクラスから呼び出した場合はそのクラスのキャッシュのみを破棄します。
+        """
+        with cls._agent_cache_lock:
+            if cls is BaseToolAgent:
+                cls._agent_cache.clear()
+                return
+            for key in [key for key in cls._agent_cache if key[0] is cls]:
+                del cls._agent_cache[key]
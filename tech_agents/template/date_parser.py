@@ -0,0 +1,57 @@
+import re
+import unicodedata
+from typing import List, Optional, Tuple
+
+
+# 各月の日数 (うるう年)
+DAYS_IN_MONTH = (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+_KANJI_DIGITS = {"〇": 0, "一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+# 1〜39 の漢数字 (一・十・二十四・三十一 など)
+_NUMBER = r"\d{1,2}|[二三]?十[一二三四五六七八九]?|[一二三四五六七八九]"
+
+# 2000年4月24日・4月24日・四月二十四日 (前に数字が続く「十十月」「112月」などは日付として扱わない)
+_KANJI_DATE_PATTERN = re.compile(
+    rf"(?<![\d〇一二三四五六七八九十])(?:\d{{4}}\s*年\s*)?(?P<month>{_NUMBER})\s*月\s*(?P<day>{_NUMBER})\s*日")
+# 2000/4/24・2000-04-24・4/24・04-24
+_NUMERIC_DATE_PATTERN = re.compile(
+    r"(?<![\d/\-])(?:\d{4}[/\-])?(?P<month>\d{1,2})[/\-](?P<day>\d{1,2})(?![\d/\-])")
+
+
+def parse_number(text: str) -> Optional[int]:  # 算用数字・漢数字 (三十九 まで) を整数に変換する関数
+    # 数として読めない場合 (「十十」など) は None を返します。
+    if text.isdigit():
+        return int(text)
+    try:
+        if "十" in text:
+            tens, _, ones = text.partition("十")
+            return (_KANJI_DIGITS[tens] if tens else 1) * 10 + (_KANJI_DIGITS[ones] if ones else 0)
+        value = 0
+        for char in text:
+            value = value * 10 + _KANJI_DIGITS[char]
+        return value
+    except KeyError:
+        return None
+
+
+def is_valid_date(month: int, day: int) -> bool:
+    # うるう年の2月29日も有効な日付として扱います。
+    return 1 <= month <= 12 and 1 <= day <= DAYS_IN_MONTH[month - 1]
+
+
+def find_dates(text: str) -> List[Tuple[int, int, int, int]]:
+    """
+    テキストに含まれる月日を、出現順に (月, 日, 開始位置, 終了位置) のリストで返します。
+    位置は全角・半角を正規化 (NFKC) したテキストでの位置です。存在しない日付 (2月30日など) も含みますが、数として読めない月日は含みません。
+    """
+    text = unicodedata.normalize("NFKC", text)
+    dates = []
+    for pattern in (_KANJI_DATE_PATTERN, _NUMERIC_DATE_PATTERN):
+        for match in pattern.finditer(text):
+            if any(start < match.end() and match.start() < end for _, _, start, end in dates):
+                continue
+            month, day = parse_number(match.group("month")), parse_number(match.group("day"))
+            if month is None or day is None:
+                continue
+            dates.append((month, day, match.start(), match.end()))
+    return sorted(dates, key=lambda date: date[2])
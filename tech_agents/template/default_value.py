@@ -5,6 +5,8 @@ from langchain.memory import ConversationBufferMemory, ReadOnlySharedMemory
 from langchain.prompts.chat import MessagesPlaceholder
 from langchain_openai import AzureOpenAIEmbeddings
 
+from tech_agents.template.embedding_cache import CachedEmbeddings
+from tech_agents.template.memory import HistoryBudget
 
 
 # デフォルトのLLMの定義
@@ -22,14 +24,32 @@ default_memory = ConversationBufferMemory(
 default_chat_history = MessagesPlaceholder(variable_name='chat_history')
 default_readonly_memory = ReadOnlySharedMemory(memory=default_memory)
 
+# エージェントに渡す会話履歴の上限の定義
+# ルーターは直近の数ターンのみで十分なため短くする
+default_router_history_budget = HistoryBudget(max_turns=3, max_tokens=1000)
+default_tool_history_budget = HistoryBudget(max_turns=10, max_tokens=3000)
+
 default_embeddings_model = AzureOpenAIEmbeddings(
     azure_deployment=os.environ["DEPLOYMENT_EMBEDDINGS_NAME"],
     chunk_size=1
 )
+# データ登録時に、複数のテキストを1回のリクエストでまとめて埋め込むためのモデル
+# 再試行は tech_db.embedding で指数バックオフを行うため、クライアントでは再試行しない
+batch_embeddings_model = AzureOpenAIEmbeddings(
+    azure_deployment=os.environ["DEPLOYMENT_EMBEDDINGS_NAME"],
+    chunk_size=int(os.environ.get("EMBEDDING_BATCH_SIZE", "16")),
+    max_retries=0
+)
 
 # azure AI Search 関係の定義
 vector_store_address: str = os.environ["AZURE_SEARCH_ENDPOINT"]
 vector_store_password: str = os.environ["AZURE_SEARCH_KEY"]
-embeddings: AzureOpenAIEmbeddings = default_embeddings_model
+# 検索のたびにクエリを埋め込まないように、埋め込みはキャッシュして再利用する
+# EMBEDDING_CACHE_PATH を指定した場合は、キャッシュをファイルに保存してプロセスをまたいで再利用する
+embeddings: CachedEmbeddings = CachedEmbeddings(
+    default_embeddings_model,
+    max_entries=int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "10000")),
+    path=os.environ.get("EMBEDDING_CACHE_PATH"),
+)
 embedding_function = embeddings.embed_query
 
@@ -0,0 +1,41 @@
+from typing import Optional
+
+
+class DialogState:
+    """
+    セッションごとの対話の状態です。
+    遅延届・公欠届のような複数ターンにわたる手続きの実行中は、その手続きの名前を active_procedure に保持します。
+    手続きの実行中は、ディスパッチャーがルーターを通さずに手続きの担当者へ振り分けます。
+
+    - 手続きは担当のツールが申請の完了・キャンセル時に end で終了します。
+    - 手続きが max_turns ターン続いた場合は、誤って固定され続けないように自動的に終了します。
+    """
+
+    def __init__(self, max_turns: int = 20):
+        self.max_turns = max_turns
+        self.active_procedure: Optional[str] = None
+        # 手続きを開始してから完了したターン数
+        self.turns = 0
+
+    @property
+    def is_active(self) -> bool:
+        return self.active_procedure is not None
+
+    def begin(self, procedure: str) -> None:
+        # 手続きを開始します。同じ手続きが実行中の場合は何もしません。
+        if self.active_procedure != procedure:
+            self.active_procedure = procedure
+            self.turns = 0
+
+    def advance(self, procedure: str) -> None:
+        # 手続きのターンを1つ進めます。
+        if self.active_procedure != procedure:
+            return
+        self.turns += 1
+        if self.turns >= self.max_turns:
+            self.end()
+
+    def end(self) -> None:
+        # 手続きを終了します。
+        self.active_procedure = None
+        self.turns = 0
@@ -0,0 +1,225 @@
+import array
+import re
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+
+
+def normalize_embedding_text(text: str) -> str:
+    # 全角・半角の違いと前後・連続する空白を吸収します。大文字・小文字は意味が変わりうるため区別します。
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class EmbeddingCacheStats:
+    """
+    埋め込みキャッシュの統計です。
+    hits はキャッシュから返した回数、misses は埋め込みモデルを呼び出した回数です。
+    disk_hits は hits のうち、ディスクのキャッシュから読み込んだ回数です。
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def record(self, hits: int = 0, misses: int = 0, disk_hits: int = 0) -> None:
+        with self._lock:
+            self.hits += hits
+            self.disk_hits += disk_hits
+            self.misses += misses
+
+    @property
+    def total(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.total if self.total else 0.0
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    埋め込みモデルの結果をキャッシュする Embeddings です。
+    同じ質問が繰り返されることが多いため、正規化したテキストと埋め込みモデルのデプロイメント名をキーに埋め込みを再利用します。
+
+    - メモリ上では LRU で最大 max_entries 件を保持します。
+    - ttl_seconds を指定した場合は、作成から ttl_seconds 秒が経過した埋め込みを再計算します。
+    - path を指定した場合は、SQLite のファイルに float32 の配列として保存し、プロセスを再起動しても再利用します。
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        namespace: Optional[str] = None,
+        max_entries: int = 10000,
+        ttl_seconds: Optional[float] = None,
+        path: Optional[str] = None,
+    ):
+        self.embeddings = embeddings
+        self.namespace = namespace or self.default_namespace(embeddings)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.stats = EmbeddingCacheStats()
+        # キー -> (作成時刻, 埋め込み)
+        self._entries: "OrderedDict[str, Tuple[float, List[float]]]" = OrderedDict()
+        self._lock = Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        if path:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, created REAL NOT NULL, vector BLOB NOT NULL)")
+            self._connection.commit()
+
+    @staticmethod
+    def default_namespace(embeddings: Embeddings) -> str:
+        # 埋め込みモデルが変わった場合に古い埋め込みを使わないように、デプロイメント名 (なければモデル名) をキーに含めます。
+        for attribute in ("deployment", "model"):
+            value = getattr(embeddings, attribute, None)
+            if value:
+                return str(value)
+        return type(embeddings).__name__
+
+    def cache_key(self, text: str) -> str:
+        return f"{self.namespace}\n{normalize_embedding_text(text)}"
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created > self.ttl_seconds
+
+    def _lookup(self, key: str) -> Tuple[Optional[List[float]], bool]:
+        # キャッシュから埋め込みを探します。(埋め込み, ディスクから読み込んだかどうか) を返します。
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._entries.move_to_end(key)
+                    return entry[1], False
+                del self._entries[key]
+            if self._connection is None:
+                return None, False
+            row = self._connection.execute(
+                "SELECT created, vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None or self._expired(row[0]):
+                return None, False
+            vector = array.array("f")
+            vector.frombytes(row[1])
+            self._remember(key, row[0], vector.tolist())
+            return self._entries[key][1], True
+
+    def _remember(self, key: str, created: float, vector: List[float]) -> None:
+        # ロックを取得した状態で呼び出してください。
+        self._entries[key] = (created, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _store(self, items: Dict[str, List[float]]) -> None:
+        created = time.time()
+        with self._lock:
+            for key, vector in items.items():
+                self._remember(key, created, vector)
+            if self._connection is not None:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)",
+                    [(key, created, array.array("f", vector).tobytes()) for key, vector in items.items()])
+                self._connection.commit()
+
+    def _partition(self, texts: List[str]) -> Tuple[List[Optional[List[float]]], Dict[str, str]]:
+        # キャッシュにある埋め込みと、埋め込みモデルで計算する必要のあるテキスト (キー -> テキスト) に分けます。
+        results: List[Optional[List[float]]] = []
+        missing: Dict[str, str] = {}
+        hits = disk_hits = 0
+        for text in texts:
+            key = self.cache_key(text)
+            vector, from_disk = self._lookup(key)
+            if vector is None and key not in missing:
+                missing[key] = text
+            elif vector is not None:
+                hits += 1
+                disk_hits += from_disk
+            results.append(vector)
+        self.stats.record(hits=hits, misses=len(missing), disk_hits=disk_hits)
+        return results, missing
+
+    def _merge(self, texts: List[str], results: List[Optional[List[float]]], computed: Dict[str, List[float]]) -> List[List[float]]:
+        if computed:
+            self._store(computed)
+        return [
+            vector if vector is not None else computed[self.cache_key(text)]
+            for text, vector in zip(texts, results)
+        ]
+
+    def uncached(self, texts: List[str]) -> List[str]:
+        # キャッシュにないテキストを重複を除いて返します。統計には記録しません。
+        missing: Dict[str, str] = {}
+        for text in texts:
+            key = self.cache_key(text)
+            if key not in missing and self._lookup(key)[0] is None:
+                missing[key] = text
+        return list(missing.values())
+
+    def store(self, texts: List[str], vectors: List[List[float]]) -> None:
+        # 別の方法 (まとめたリクエストなど) で作成した埋め込みをキャッシュに保存します。
+        self._store({self.cache_key(text): vector for text, vector in zip(texts, vectors)})
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        results, missing = self._partition(texts)
+        computed: Dict[str, List[float]] = {}
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+        return self._merge(texts, results, computed)
+
+    def embed_query(self, text: str) -> List[float]:
+        results, missing = self._partition([text])
+        computed: Dict[str, List[float]] = {}
+        if missing:
+            computed = {key: self.embeddings.embed_query(text) for key in missing}
+        return self._merge([text], results, computed)[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        results, missing = self._partition(texts)
+        computed: Dict[str, List[float]] = {}
+        if missing:
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+        return self._merge(texts, results, computed)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        results, missing = self._partition([text])
+        computed: Dict[str, List[float]] = {}
+        if missing:
+            computed = {key: await self.embeddings.aembed_query(text) for key in missing}
+        return self._merge([text], results, computed)[0]
+
+    def clear(self) -> None:
+        # メモリとディスクのキャッシュを削除します。
+        with self._lock:
+            self._entries.clear()
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM embeddings")
+                self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
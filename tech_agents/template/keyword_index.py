@@ -0,0 +1,110 @@
+import math
+import re
+from array import array
+from collections import Counter
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from tech_agents.template.pre_router import normalize_text
+
+
+# 英数字の単語と、それ以外 (かな・漢字など) の文字の連続
+_TOKEN_PATTERN = re.compile(r"[a-z0-9_]+|[^\sa-z0-9_\W]+")
+
+
+def tokenize(text: str, n: int = 2) -> List[str]:
+    """
+    形態素解析を使わずに、日本語を含むテキストをトークンに分割します。
+    英数字は単語ごとに、かな・漢字などの連続は文字の n-gram (デフォルトは2文字) に分割します。
+    n 文字に満たない連続はそのまま1つのトークンになります。
+    """
+    tokens: List[str] = []
+    for match in _TOKEN_PATTERN.finditer(normalize_text(text)):
+        run = match.group()
+        if run.isascii() or len(run) <= n:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + n] for i in range(len(run) - n + 1))
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings: Iterable[List[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """
+    複数の検索結果の順位を Reciprocal Rank Fusion で統合します。
+    rankings は、それぞれスコアの高い順に並んだドキュメント番号のリストです。
+    スコア (各順位 r について 1 / (k + r) の合計) の高い順に (ドキュメント番号, スコア) を返します。
+    """
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class KeywordIndex:
+    """
+    BM25 でスコアを計算するキーワード検索の転置インデックスです。
+    ハイブリッド検索のキーワード側として、ベクトル検索と組み合わせて使用します。
+
+    - ドキュメントは追加された順に 0 から番号が振られ、add で追加した分だけインデックスが更新されます。
+    - ポスティングはトークンごとに、ドキュメント番号と出現回数の array (int32) で保持します。
+    - ベクトルの行列など、別に保持しているドキュメントと検索対象を揃える場合は、search の limit にドキュメント数を指定してください。
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, n: int = 2):
+        self.k1 = k1
+        self.b = b
+        self.n = n
+        # トークン -> (ドキュメント番号の配列, 出現回数の配列)
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.lengths = array("i")
+        # array は参照中に拡張できないため、追加と検索時のコピーはロックで排他します
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, texts: Iterable[str]) -> None:
+        tokenized = [Counter(tokenize(text, self.n)) for text in texts]
+        with self._lock:
+            for counts in tokenized:
+                doc_id = len(self.lengths)
+                for token, frequency in counts.items():
+                    postings = self.postings.get(token)
+                    if postings is None:
+                        postings = self.postings[token] = (array("i"), array("i"))
+                    postings[0].append(doc_id)
+                    postings[1].append(frequency)
+                self.lengths.append(sum(counts.values()))
+
+    def search(self, query: str, k: int, limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        # スコアの高い順に (ドキュメント番号, スコア) を最大 k 件返します。limit 以降のドキュメントは対象外です。
+        tokens = set(tokenize(query, self.n))
+        with self._lock:
+            n = len(self.lengths) if limit is None else min(limit, len(self.lengths))
+            if n == 0:
+                return []
+            lengths = np.array(self.lengths[:n], dtype=np.int32)
+            postings = {
+                token: (np.array(self.postings[token][0], dtype=np.int32), np.array(self.postings[token][1], dtype=np.int32))
+                for token in tokens if token in self.postings
+            }
+        average_length = float(lengths.mean()) or 1.0
+        scores = np.zeros(n, dtype=np.float32)
+        for doc_ids, frequencies in postings.values():
+            mask = doc_ids < n
+            doc_ids, frequencies = doc_ids[mask], frequencies[mask].astype(np.float32)
+            if not len(doc_ids):
+                continue
+            idf = math.log(1 + (n - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths[doc_ids] / average_length)
+            scores[doc_ids] += idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        k = min(k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(int(doc_id), float(scores[doc_id])) for doc_id in top]
@@ -0,0 +1,240 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Callable, Iterator, List, Optional
+
+from langchain.memory import ConversationBufferMemory, ConversationSummaryBufferMemory, ReadOnlySharedMemory
+from langchain.schema import BaseMemory
+from langchain.schema.language_model import BaseLanguageModel
+from langchain.schema.messages import BaseMessage, HumanMessage, SystemMessage
+
+from tech_agents.template.dialog import DialogState
+
+
+class TurnMemory:
+    """
+    1ターンの実行で使用する会話メモリの組です。
+    エージェントツリーは一度だけ構築してターンをまたいで再利用するため、
+    ターンごとに変わるメモリはコンストラクタではなくこのクラスで実行時に渡します。
+    """
+    memory: BaseMemory
+    readonly_memory: ReadOnlySharedMemory
+    dialog_state: DialogState
+
+    def __init__(self, memory: BaseMemory, readonly_memory: ReadOnlySharedMemory = None, dialog_state: DialogState = None):
+        self.memory = memory
+        self.readonly_memory = readonly_memory or ReadOnlySharedMemory(memory=memory)
+        self.dialog_state = dialog_state or DialogState()
+
+
+# 実行中のターンのメモリ (スレッド・非同期タスクごとに独立します)
+_current_turn: ContextVar[Optional[TurnMemory]] = ContextVar("tech_agents_current_turn", default=None)
+
+
+@contextmanager
+def use_memory(turn: TurnMemory) -> Iterator[TurnMemory]:
+    """
+    with ブロックの中で実行されるエージェントに、指定したターンのメモリを使用させます。
+    """
+    token = _current_turn.set(turn)
+    try:
+        yield turn
+    finally:
+        _current_turn.reset(token)
+
+
+def current_turn() -> Optional[TurnMemory]:
+    # 実行中のターンを返します。ターンの外では None を返します。
+    return _current_turn.get()
+
+
+def current_dialog() -> Optional[DialogState]:
+    # 実行中のターンの対話の状態を返します。ターンの外では None を返します。
+    turn = _current_turn.get()
+    return turn.dialog_state if turn else None
+
+
+def end_procedure() -> None:
+    # 実行中の手続きを終了します。手続きの完了・キャンセル時にツールから呼び出します。
+    dialog = current_dialog()
+    if dialog is not None:
+        dialog.end()
+
+
+def resolve_memory(memory: BaseMemory) -> BaseMemory:
+    """
+    構築時に渡されたメモリを、実行中のターンのメモリに置き換えて返します。
+    読み取り専用メモリで構築されたエージェントには読み取り専用メモリを、書き込み可能なメモリで構築されたエージェントには書き込み可能なメモリを返します。
+    ターンの外で呼ばれた場合は、構築時のメモリをそのまま返します。
+    """
+    turn = _current_turn.get()
+    if turn is None:
+        return memory
+    if isinstance(memory, ReadOnlySharedMemory):
+        return turn.readonly_memory
+    return turn.memory
+
+
+def create_buffer_memory() -> ConversationBufferMemory:
+    # セッションごとに作成するデフォルトの会話メモリ
+    return ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+
+
+def summary_memory_factory(llm: BaseLanguageModel, max_token_limit: int = 2000) -> Callable[[], ConversationSummaryBufferMemory]:
+    """
+    直近の会話を max_token_limit トークン分だけ保持し、それより古い会話を要約して保持するメモリの作成関数を返します。
+    SessionMemoryStore の memory_factory に指定して使用します。
+    要約は先頭の SystemMessage として履歴に含まれます。
+    """
+    def create_summary_memory() -> ConversationSummaryBufferMemory:
+        return ConversationSummaryBufferMemory(
+            llm=llm, memory_key="chat_history", return_messages=True, max_token_limit=max_token_limit)
+    return create_summary_memory
+
+
+def approximate_token_count(messages: List[BaseMessage]) -> int:
+    # 文字数によるトークン数の概算 (日本語はおおよそ1文字1トークン、英語は多めに見積もられます)
+    return sum(len(message.content) for message in messages if isinstance(message.content, str))
+
+
+class HistoryBudget:
+    """
+    エージェントに渡す会話履歴の上限です。エージェントごとに異なる上限を設定できます。
+
+    - max_turns: 直近何ターン分の履歴を渡すか。None の場合は制限しません。
+    - max_tokens: 渡す履歴のトークン数の上限。None の場合は制限しません。
+    - token_counter: トークン数の数え方。デフォルトは文字数による概算で、正確に数える場合は llm.get_num_tokens_from_messages を指定します。
+
+    履歴の先頭にある SystemMessage (要約) は常に残し、トークン数の計算に含めます。
+    """
+
+    def __init__(
+        self,
+        max_turns: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        token_counter: Callable[[List[BaseMessage]], int] = approximate_token_count,
+    ):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.token_counter = token_counter
+
+    def trim(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        # 先頭の要約と会話本体に分ける
+        summary_end = 0
+        while summary_end < len(messages) and isinstance(messages[summary_end], SystemMessage):
+            summary_end += 1
+        head, body = messages[:summary_end], messages[summary_end:]
+
+        if self.max_turns is not None:
+            # ターンはユーザーの発言から始まるものとして数える
+            turn_starts = [i for i, message in enumerate(body) if isinstance(message, HumanMessage)]
+            if self.max_turns <= 0:
+                body = []
+            elif len(turn_starts) > self.max_turns:
+                body = body[turn_starts[-self.max_turns]:]
+
+        if self.max_tokens is not None:
+            # 新しいメッセージから順に、上限に収まるだけ残す
+            remaining = self.max_tokens - self.token_counter(head)
+            kept = 0
+            for message in reversed(body):
+                remaining -= self.token_counter([message])
+                if remaining < 0:
+                    break
+                kept += 1
+            body = body[len(body) - kept:]
+
+        return head + body
+
+    def apply(self, memory_variables: dict, memory_key: str = "chat_history") -> dict:
+        # load_memory_variables の結果の会話履歴を上限に収めます。
+        history = memory_variables.get(memory_key)
+        if not isinstance(history, list):
+            return memory_variables
+        return {**memory_variables, memory_key: self.trim(history)}
+
+
+def load_history(memory: BaseMemory, budget: Optional[HistoryBudget] = None) -> dict:
+    # メモリから会話履歴を読み込み、上限が指定されていれば上限に収めて返します。
+    memory_variables = memory.load_memory_variables({})
+    if budget is None:
+        return memory_variables
+    return budget.apply(memory_variables)
+
+
+class SessionMemoryStore:
+    """
+    セッションIDごとの会話メモリを保持するストアです。
+    1つのプロセスで複数のユーザーとの会話を並行して扱うために使用します。
+
+    - 保持するセッション数が max_sessions を超えた場合、最も長く使われていないセッションから破棄します (LRU)。
+    - 最後に使われてから ttl_seconds 秒が経過したセッションは破棄します (TTL)。ttl_seconds が None の場合は破棄しません。
+    - memory_factory で新しいセッションのメモリの作成方法を変更できます。
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        ttl_seconds: Optional[float] = 60 * 60,
+        memory_factory: Callable[[], BaseMemory] = create_buffer_memory,
+    ):
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be 1 or more.")
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.memory_factory = memory_factory
+        # セッションID -> (ターンのメモリ, 最終アクセス時刻) を最終アクセス順に保持する
+        self._sessions: "OrderedDict[str, tuple[TurnMemory, float]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, session_id: str) -> TurnMemory:
+        """
+        セッションのメモリを返します。存在しない場合は新しく作成します。
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict_expired(now)
+            entry = self._sessions.pop(session_id, None)
+            turn = entry[0] if entry else TurnMemory(self.memory_factory())
+            self._sessions[session_id] = (turn, now)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return turn
+
+    def delete(self, session_id: str) -> None:
+        # セッションを破棄します。
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def clear(self) -> None:
+        # 全てのセッションを破棄します。
+        with self._lock:
+            self._sessions.clear()
+
+    def evict_expired(self) -> int:
+        # 期限切れのセッションを破棄し、破棄した数を返します。
+        with self._lock:
+            return self._evict_expired(time.monotonic())
+
+    def _evict_expired(self, now: float) -> int:
+        if self.ttl_seconds is None:
+            return 0
+        evicted = 0
+        # 最終アクセス順に並んでいるため、先頭から期限切れでないものが見つかるまで破棄する
+        while self._sessions:
+            session_id, (_, last_access) = next(iter(self._sessions.items()))
+            if now - last_access < self.ttl_seconds:
+                break
+            del self._sessions[session_id]
+            evicted += 1
+        return evicted
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._sessions
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
@@ -0,0 +1,116 @@
+import os
+import sqlite3
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from tech_agents.template.models import Document
+
+
+def default_parent_store_path() -> str:
+    # ローカルのインデックスを使用する場合は、インデックスと同じディレクトリに保存する
+    return os.environ.get("PARENT_STORE_PATH") or os.path.join(
+        os.environ.get("LOCAL_VECTOR_DIR") or ".index_manifest", "parents.sqlite3")
+
+
+class ParentStore:
+    """
+    チャンクの分割元の文章 (親の文章) を保存するストアです。
+    親の文章は1度だけ保存し、チャンクのメタデータには parent_id のみを保持します。
+    検索時に parent_id から親の文章を取得して回答に使用します。
+    ローカルのファイルのため、登録と検索を同じマシンで行うローカルのインデックス (VECTOR_BACKEND=local) でのみ使用します。
+
+    - SQLite のファイル (path) に、インデックス名・親のID・行のID・文章を保存します。
+    - 最初に使用するときにファイルを開きます。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or default_parent_store_path()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # ロックを取得した状態で呼び出してください。
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS parents (index_name TEXT NOT NULL, id TEXT NOT NULL, source TEXT NOT NULL, content TEXT NOT NULL, PRIMARY KEY (index_name, id))")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS parents_source ON parents (index_name, source)")
+            self._connection.commit()
+        return self._connection
+
+    def put(self, index_name: str, parents: Iterable[Tuple[str, str, str]]) -> None:
+        # (親のID, 行のID, 文章) を保存します。
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                "INSERT OR REPLACE INTO parents (index_name, id, source, content) VALUES (?, ?, ?, ?)",
+                [(index_name, id, source, content) for id, source, content in parents])
+            connection.commit()
+
+    def get(self, index_name: str, ids: Iterable[str]) -> Dict[str, str]:
+        # 親のID -> 文章 を返します。保存されていないIDは含みません。
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return {}
+        result: Dict[str, str] = {}
+        with self._lock:
+            connection = self._connect()
+            # SQLite のパラメーター数の上限を超えないように分けて取得する
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT id, content FROM parents WHERE index_name = ? AND id IN ({', '.join('?' * len(batch))})",
+                    [index_name, *batch]).fetchall()
+                result.update(rows)
+        return result
+
+    def remove_stale(self, index_name: str, keep: Dict[str, Iterable[str]]) -> None:
+        # 行のID -> 残す親のID を受け取り、それぞれの行の親の文章のうち残す親のIDにないものを削除します。
+        with self._lock:
+            connection = self._connect()
+            for source, ids in keep.items():
+                ids = list(ids)
+                connection.execute(
+                    f"DELETE FROM parents WHERE index_name = ? AND source = ? AND id NOT IN ({', '.join('?' * len(ids))})",
+                    [index_name, source, *ids])
+            connection.commit()
+
+    def clear(self, index_name: str) -> None:
+        # インデックスの全ての親の文章を削除します。
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM parents WHERE index_name = ?", (index_name,))
+            connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+# プロセス全体で共有する親の文章のストア
+parent_store = ParentStore()
+
+
+def split_sources(index_name: str, docs: List[Document]) -> List[str]:  # 検索結果の分割元の文章を取得する関数
+    """
+    検索結果のチャンクごとに、分割元の文章を返します。
+    チャンクが metadata の split_source に文章を保持している場合 (Azure AI Search や以前の形式のインデックス) はその文章を返し、
+    親の文章が見つからない場合はチャンクの文章を返します。
+    """
+    ids = [doc.metadata["parent_id"] for doc in docs if "parent_id" in doc.metadata and "split_source" not in doc.metadata]
+    parents = parent_store.get(index_name, ids)
+    missing = set(ids) - set(parents)
+    if missing:
+        # 回答の文脈がチャンクの文章だけになるため、登録 (add_vector) とストアの不整合に気付けるように表示する
+        print(f"{index_name} の親の文章が {len(missing)}件見つかりません ({parent_store.path})。チャンクの文章を使用します。")
+    return [
+        doc.metadata.get("split_source") or parents.get(doc.metadata.get("parent_id"), doc.page_content)
+        for doc in docs
+    ]
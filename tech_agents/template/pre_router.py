@@ -0,0 +1,126 @@
+import copy
+import re
+import unicodedata
+from threading import Lock
+from typing import Dict, Iterable, List, Optional
+
+
+def normalize_text(text: str) -> str:
+    # 全角・半角や大文字・小文字の違いを吸収します。
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+class RouteRule:
+    """
+    事前ルーターのルールです。
+    keywords のいずれかを含む、または patterns (正規表現) のいずれかに一致する入力を destination に振り分けます。
+    一致したキーワード・パターンごとに weight がスコアに加算されます。
+    """
+
+    def __init__(
+        self,
+        destination: str,
+        keywords: Iterable[str] = (),
+        patterns: Iterable[str] = (),
+        weight: float = 1.0,
+    ):
+        self.destination = destination
+        self.keywords = [normalize_text(keyword) for keyword in keywords]
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.weight = weight
+
+    def renamed(self, destination: str) -> "RouteRule":
+        # 振り分け先のみを変更したルールを返します。
+        rule = copy.copy(self)
+        rule.destination = destination
+        return rule
+
+    def score(self, text: str) -> float:
+        # text は normalize_text で正規化済みのものを渡してください。
+        matched = sum(1 for keyword in self.keywords if keyword in text)
+        matched += sum(1 for pattern in self.patterns if pattern.search(text))
+        return matched * self.weight
+
+
+class PreRouterStats:
+    """
+    事前ルーターの統計です。
+    hits は LLM を使わずに振り分けた回数、misses は LLM のルーターに任せた回数です。
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.destinations: Dict[str, int] = {}
+        self._lock = Lock()
+
+    def record(self, destination: Optional[str]) -> None:
+        with self._lock:
+            if destination is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.destinations[destination] = self.destinations.get(destination, 0) + 1
+
+    @property
+    def total(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.total if self.total else 0.0
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate,
+                "destinations": dict(self.destinations),
+            }
+
+
+class PreRouter:
+    """
+    LLM のルーターの前段で、キーワードと正規表現のみで振り分け先を決める事前ルーターです。
+
+    - 最もスコアの高い振り分け先のスコアが min_score 以上で、
+      かつ2番目のスコアとの差が min_margin 以上の場合のみ振り分け先を返します。
+    - それ以外の場合は None を返し、LLM のルーターに判断を任せます。
+    """
+
+    def __init__(self, rules: List[RouteRule], min_score: float = 1.0, min_margin: float = 1.0):
+        self.rules = rules
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.stats = PreRouterStats()
+
+    @property
+    def destinations(self) -> set:
+        return {rule.destination for rule in self.rules}
+
+    def scores(self, text: str) -> Dict[str, float]:
+        # 振り分け先ごとのスコアを返します。
+        text = normalize_text(text)
+        scores: Dict[str, float] = {}
+        for rule in self.rules:
+            score = rule.score(text)
+            if score:
+                scores[rule.destination] = scores.get(rule.destination, 0.0) + score
+        return scores
+
+    def predict(self, text: str) -> Optional[str]:
+        # 統計を記録せずに振り分け先を判定します。
+        ranked = sorted(self.scores(text).items(), key=lambda item: item[1], reverse=True)
+        if not ranked or ranked[0][1] < self.min_score:
+            return None
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        if ranked[0][1] - runner_up < self.min_margin:
+            return None
+        return ranked[0][0]
+
+    def route(self, text: str) -> Optional[str]:
+        # 振り分け先を判定し、統計を記録します。
+        destination = self.predict(text)
+        self.stats.record(destination)
+        return destination
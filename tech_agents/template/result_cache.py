@@ -0,0 +1,196 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from tech_agents.template.embedding_cache import normalize_embedding_text
+from tech_agents.template.models import Document
+
+
+class ResultCacheStats:
+    """
+    検索結果キャッシュの統計です。
+    hits はキャッシュした検索結果を返した回数、misses はインデックスを検索した回数です。
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = Lock()
+
+    def record(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def record_invalidation(self) -> None:
+        with self._lock:
+            self.invalidations += 1
+
+    @property
+    def total(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.total if self.total else 0.0
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate,
+                "invalidations": self.invalidations,
+            }
+
+
+class _IndexEntries:
+    # 1つのインデックス・件数 (k) の組に対するキャッシュです。クエリの埋め込みを行列として保持します。
+
+    def __init__(self):
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.created: List[float] = []
+        self.documents: List[List[Document]] = []
+
+    def drop(self, keep: np.ndarray) -> None:
+        self.vectors = self.vectors[keep]
+        self.created = [c for c, k in zip(self.created, keep) if k]
+        self.documents = [d for d, k in zip(self.documents, keep) if k]
+
+
+class SemanticResultCache:
+    """
+    意味的に近いクエリの検索結果を再利用するキャッシュです。
+    クエリの埋め込みと、キャッシュしたクエリの埋め込みのコサイン類似度が threshold 以上であれば、
+    インデックスを検索せずにキャッシュした Document のリストを返します。
+
+    - キャッシュはインデックス名と検索件数 (k) ごとに分けて保持します。
+    - ttl_seconds 秒が経過した検索結果は使用しません。
+    - インデックスごとに最大 max_entries 件を保持し、超えた場合は古いものから削除します。
+    - インデックスのデータを更新した場合は invalidate でそのインデックスのキャッシュを削除してください。
+    """
+
+    def __init__(self, threshold: float = 0.97, ttl_seconds: float = 600, max_entries: int = 256):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stats = ResultCacheStats()
+        self._entries: Dict[Tuple[str, int], _IndexEntries] = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def _evict_expired(self, entries: _IndexEntries, now: float) -> None:
+        # ロックを取得した状態で呼び出してください。
+        if entries.created and now - entries.created[0] > self.ttl_seconds:
+            entries.drop(np.array([now - c <= self.ttl_seconds for c in entries.created], dtype=bool))
+
+    def get(self, index_name: str, query_vector: List[float], k: int) -> Optional[List[Document]]:
+        # 意味的に近いクエリの検索結果があれば返します。なければ None を返します。
+        query = self._normalize(query_vector)
+        with self._lock:
+            entries = self._entries.get((index_name, k))
+            documents = None
+            if entries is not None:
+                self._evict_expired(entries, time.time())
+                if entries.documents and entries.vectors.shape[1] == query.shape[0]:
+                    similarities = entries.vectors @ query
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.threshold:
+                        documents = list(entries.documents[best])
+        self.stats.record(documents is not None)
+        return documents
+
+    def put(self, index_name: str, query_vector: List[float], k: int, documents: List[Document]) -> None:
+        query = self._normalize(query_vector)
+        with self._lock:
+            entries = self._entries.setdefault((index_name, k), _IndexEntries())
+            if entries.vectors.shape[1] != query.shape[0]:
+                # 埋め込みの次元が変わった場合 (埋め込みモデルの変更) は、古いキャッシュを使わない
+                entries.vectors = np.empty((0, query.shape[0]), dtype=np.float32)
+                entries.created, entries.documents = [], []
+            entries.vectors = np.vstack([entries.vectors, query[np.newaxis, :]])
+            entries.created.append(time.time())
+            entries.documents.append(list(documents))
+            if len(entries.documents) > self.max_entries:
+                keep = np.ones(len(entries.documents), dtype=bool)
+                keep[:len(entries.documents) - self.max_entries] = False
+                entries.drop(keep)
+
+    def invalidate(self, index_name: Optional[str] = None) -> None:
+        # index_name のキャッシュを削除します。index_name が None の場合は全て削除します。
+        with self._lock:
+            for key in list(self._entries):
+                if index_name is None or key[0] == index_name:
+                    del self._entries[key]
+        self.stats.record_invalidation()
+
+    def __len__(self) -> int:
+        return sum(len(entries.documents) for entries in self._entries.values())
+
+
+class QueryResultCache:
+    """
+    クエリの文字列が同じ検索の結果を再利用するキャッシュです。
+    キーワード検索のように埋め込みを使用しない検索では、SemanticResultCache を使うとクエリの埋め込みの作成が増えるため、こちらを使用します。
+
+    - 全角・半角、大文字・小文字、空白の違いを正規化したクエリと、インデックス名・検索件数 (k) をキーにします。
+    - ttl_seconds 秒が経過した検索結果は使用しません。
+    - 最大 max_entries 件を保持し、超えた場合は最も長く使われていないものから削除します。
+    """
+
+    def __init__(self, ttl_seconds: float = 600, max_entries: int = 256):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stats = ResultCacheStats()
+        # (インデックス名, k, 正規化したクエリ) -> (作成時刻, 検索結果)
+        self._entries: "OrderedDict[Tuple[str, int, str], Tuple[float, List[Document]]]" = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(index_name: str, query: str, k: int) -> Tuple[str, int, str]:
+        return (index_name, k, normalize_embedding_text(query).lower())
+
+    def get(self, index_name: str, query: str, k: int) -> Optional[List[Document]]:
+        # 同じクエリの検索結果があれば返します。なければ None を返します。
+        key = self._key(index_name, query, k)
+        with self._lock:
+            entry = self._entries.get(key)
+            documents = None
+            if entry is not None:
+                if time.time() - entry[0] > self.ttl_seconds:
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    documents = list(entry[1])
+        self.stats.record(documents is not None)
+        return documents
+
+    def put(self, index_name: str, query: str, k: int, documents: List[Document]) -> None:
+        key = self._key(index_name, query, k)
+        with self._lock:
+            self._entries[key] = (time.time(), list(documents))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, index_name: Optional[str] = None) -> None:
+        # index_name のキャッシュを削除します。index_name が None の場合は全て削除します。
+        with self._lock:
+            for key in list(self._entries):
+                if index_name is None or key[0] == index_name:
+                    del self._entries[key]
+        self.stats.record_invalidation()
+
+    def __len__(self) -> int:
+        return len(self._entries)
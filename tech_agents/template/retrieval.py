@@ -0,0 +1,76 @@
+import os
+from typing import List, Optional, Tuple
+
+from tech_agents.template.models import Document
+from tech_agents.template.parent_store import split_sources
+
+
+# 検索結果から回答に使用する文章の合計トークン数の上限
+CONTEXT_MAX_TOKENS = int(os.environ.get("SEARCH_CONTEXT_MAX_TOKENS", "1200"))
+
+
+def approximate_tokens(text: str) -> int:
+    # 文字数によるトークン数の概算 (日本語はおおよそ1文字1トークン)
+    return len(text)
+
+
+def merge_passages(first: str, second: str, min_overlap: int = 10) -> Optional[str]:
+    """
+    同じ行の2つの文章が重なっている場合は、1つにつなげた文章を返します。重なっていない場合は None を返します。
+    親の文章は chunk_overlap だけ前後の文章と重なるため、末尾と先頭が min_overlap 文字以上一致する場合につなげます。
+    """
+    if second in first:
+        return first
+    if first in second:
+        return second
+    for size in range(min(len(first), len(second)) - 1, min_overlap - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+        if second.endswith(first[:size]):
+            return second + first[size:]
+    return None
+
+
+def assemble_context(
+    index_name: str,
+    docs: List[Document],
+    max_tokens: Optional[int] = None,
+    max_passages: Optional[int] = None,
+) -> List[str]:
+    """
+    検索結果のチャンクから、回答に使用する分割元の文章を重複なく返します。
+
+    - 同じ親の文章から複数のチャンクが検索された場合は、親の文章を1度だけ返します。
+    - 同じ行の重なっている親の文章は、1つの文章につなげます。
+    - 文章は、その文章の中で最も順位の高いチャンクの順に並べ、合計トークン数が max_tokens、件数が max_passages に収まるまで追加します。
+    """
+    max_tokens = max_tokens or CONTEXT_MAX_TOKENS
+    # (行のID, 文章) を、最も順位の高いチャンクの順に保持する
+    passages: List[Tuple[Optional[str], str]] = []
+    seen = set()
+    for doc, text in zip(docs, split_sources(index_name, docs)):
+        key = doc.metadata.get("parent_id") or text
+        if key in seen:
+            continue
+        seen.add(key)
+        source = doc.metadata.get("source_id")
+        for i, (passage_source, passage) in enumerate(passages):
+            merged = merge_passages(passage, text) if source is not None and passage_source == source else None
+            if merged is not None:
+                passages[i] = (passage_source, merged)
+                break
+        else:
+            passages.append((source, text))
+
+    context: List[str] = []
+    tokens = 0
+    for _, passage in passages:
+        if max_passages is not None and len(context) >= max_passages:
+            break
+        passage_tokens = approximate_tokens(passage)
+        # 上限を超える文章は飛ばし、順位の低い短い文章で残りを埋める。1件目は上限を超えても返す
+        if context and tokens + passage_tokens > max_tokens:
+            continue
+        context.append(passage)
+        tokens += passage_tokens
+    return context
@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator, Optional
+
+from langchain.callbacks.base import BaseCallbackHandler, BaseCallbackManager
+
+
+# ルーターチェーンの LLM 呼び出しに付けるタグ。このタグの付いた呼び出しのトークンは回答として配信しません。
+ROUTER_TAG = "dispatcher_router"
+
+
+class StreamEvent:
+    """
+    ストリーミング実行中に配信されるイベントです。
+
+    - route: ディスパッチャーが振り分け先を決めたときのイベントです。data は振り分け先のツールの名前です。
+    - token: 回答のトークンです。return_direct のツールの出力など、トークン単位で生成されない回答は1つのトークンとして配信されます。
+    - final: 回答全体です。ストリームの最後に1度だけ配信されます。
+    """
+
+    def __init__(self, type: str, data: str):
+        self.type = type
+        self.data = data
+
+    def __repr__(self) -> str:
+        return f"StreamEvent(type={self.type!r}, data={self.data!r})"
+
+
+_current_sink: ContextVar[Optional[Callable[[StreamEvent], None]]] = ContextVar("current_stream_sink", default=None)
+
+
+@contextmanager
+def use_stream(sink: Callable[[StreamEvent], None]) -> Iterator[None]:
+    # ブロック内で発生したイベントを sink に渡します。
+    token = _current_sink.set(sink)
+    try:
+        yield
+    finally:
+        _current_sink.reset(token)
+
+
+def emit_event(event: StreamEvent) -> None:
+    # ストリーミング実行中であればイベントを配信します。通常の実行中は何もしません。
+    sink = _current_sink.get()
+    if sink is not None:
+        sink(event)
+
+
+class StreamingCallbackHandler(BaseCallbackHandler):
+    """
+    LLM の生成したトークンを、実行中のストリームへ token イベントとして配信するコールバックです。
+    ルーターチェーン (ROUTER_TAG の付いた呼び出し) のトークンと、Function Calling の引数のみの空のトークンは配信しません。
+    """
+
+    # 非同期実行時もイベントループ上で直接呼び出し、ストリームのコンテキストを引き継ぎます。
+    run_inline = True
+
+    def on_llm_new_token(self, token: str, *, tags: Optional[list] = None, **kwargs: Any) -> None:
+        if not token or (tags and ROUTER_TAG in tags):
+            return
+        emit_event(StreamEvent("token", token))
+
+
+def streaming_llm(llm):
+    """
+    llm をコピーし、トークンをストリームへ配信する LLM を作成します。
+    ストリーミングに対応していない LLM の場合は、コールバックのみを追加します。
+    """
+    callbacks = llm.callbacks
+    if isinstance(callbacks, BaseCallbackManager):
+        callbacks = callbacks.copy()
+        callbacks.add_handler(StreamingCallbackHandler())
+    else:
+        callbacks = list(callbacks or []) + [StreamingCallbackHandler()]
+    update = {"callbacks": callbacks}
+    if "streaming" in llm.__fields__:
+        update["streaming"] = True
+    return llm.copy(update=update)
@@ -0,0 +1,345 @@
+import asyncio
+import base64
+import json
+import os
+import uuid
+from threading import Lock
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_community.vectorstores.azuresearch import FIELDS_ID, AzureSearch
+
+from tech_agents.template import default_value
+from tech_agents.template.keyword_index import KeywordIndex, reciprocal_rank_fusion
+from tech_agents.template.models import Document
+
+
+def create_vector_store(index_name: str) -> AzureSearch:  # ベクトルストア作成関数
+    return AzureSearch(
+        azure_search_endpoint=default_value.vector_store_address,
+        azure_search_key=default_value.vector_store_password,
+        index_name=index_name,
+        embedding_function=default_value.embeddings.embed_query,
+    )
+
+
+class VectorStoreRegistry:
+    """
+    インデックス名ごとに AzureSearch を1つだけ作成し、プロセス全体で再利用するためのレジストリです。
+    AzureSearch の作成時にはインデックスの確認と認証の通信が発生するため、検索のたびに作成せずに使い回します。
+    各 AzureSearch の SearchClient は HTTP のセッションを保持しているため、接続も keep-alive で再利用されます。
+
+    - ベクトルストアは最初に使用されたときに作成されます。
+    - 複数のスレッドから同時に使用しても、インデックスごとに1つしか作成されません。
+    - close で SearchClient を閉じ、レジストリから削除します。次に使用されたときは再作成されます。
+    """
+
+    def __init__(self, factory=create_vector_store):
+        self.factory = factory
+        self._stores: Dict[str, AzureSearch] = {}
+        self._lock = Lock()
+
+    def find(self, index_name: str) -> Optional[AzureSearch]:
+        # 作成済みのベクトルストアを返します。作成されていない場合は None を返します。
+        return self._stores.get(index_name)
+
+    def get(self, index_name: str) -> AzureSearch:
+        vector_store = self._stores.get(index_name)
+        if vector_store is None:
+            with self._lock:
+                vector_store = self._stores.get(index_name)
+                if vector_store is None:
+                    vector_store = self.factory(index_name)
+                    self._stores[index_name] = vector_store
+        return vector_store
+
+    def close(self, index_name: Optional[str] = None) -> None:
+        # index_name のベクトルストアを閉じます。index_name が None の場合は全て閉じます。
+        with self._lock:
+            if index_name is None:
+                stores = list(self._stores.values())
+                self._stores.clear()
+            else:
+                store = self._stores.pop(index_name, None)
+                stores = [store] if store is not None else []
+        for store in stores:
+            client = getattr(store, "client", None)
+            if client is not None:
+                client.close()
+
+    def __len__(self) -> int:
+        return len(self._stores)
+
+
+class VectorBackend:
+    """
+    search_vector・dilect_vector が使用するベクトル検索の実装の基底クラスです。
+    このクラスを継承して、add_documents・delete_documents と search を実装してください。
+    """
+
+    # チャンクのメタデータ (split_source) に親の文章を保持するか。
+    # 検索するプロセスが登録したマシンの ParentStore を読めない場合は True にします。
+    inline_parents = True
+
+    def add_documents(self, index_name: str, documents: List[Document], ids: Optional[List[str]] = None) -> None:
+        # ids を指定した場合は、同じ id のドキュメントを置き換えます。省略した場合は新しい id を振ります。
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def delete_documents(self, index_name: str, ids: List[str]) -> None:
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def count(self, index_name: str) -> int:
+        # インデックスのドキュメント数を返します。
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def clear(self, index_name: str) -> int:
+        # インデックスの全てのドキュメントを削除し、削除した件数を返します。
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def search(self, index_name: str, query: str, k: int = 3) -> List[Document]:
+        # ベクトル検索とキーワード検索を組み合わせたハイブリッド検索の結果を返します。
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    async def asearch(self, index_name: str, query: str, k: int = 3) -> List[Document]:
+        return await asyncio.to_thread(self.search, index_name, query, k)
+
+    def close(self, index_name: Optional[str] = None) -> None:
+        pass
+
+
+class AzureSearchBackend(VectorBackend):
+    """
+    Azure AI Search のインデックスを使用するバックエンドです。
+    """
+
+    def __init__(self, registry: Optional[VectorStoreRegistry] = None):
+        self.registry = registry or VectorStoreRegistry()
+
+    @staticmethod
+    def document_key(id: str) -> str:
+        # AzureSearch.add_texts はキーを URL セーフな base64 にして登録するため、削除時も同じ変換を行います。
+        return base64.urlsafe_b64encode(id.encode("utf-8")).decode("ascii")
+
+    def add_documents(self, index_name: str, documents: List[Document], ids: Optional[List[str]] = None) -> None:
+        if ids is None:
+            self.registry.get(index_name).add_documents(documents=documents)
+        else:
+            self.registry.get(index_name).add_documents(documents=documents, keys=ids)
+
+    def delete_documents(self, index_name: str, ids: List[str]) -> None:
+        if ids:
+            self.registry.get(index_name).client.delete_documents(
+                documents=[{FIELDS_ID: self.document_key(id)} for id in ids])
+
+    def count(self, index_name: str) -> int:
+        return self.registry.get(index_name).client.get_document_count()
+
+    def clear(self, index_name: str) -> int:
+        # 登録時のキー (uuid や base64 にしたID) が分からないため、全てのドキュメントのキーを取得して削除します。
+        client = self.registry.get(index_name).client
+        keys = [result[FIELDS_ID] for result in client.search(search_text="*", select=[FIELDS_ID])]
+        for start in range(0, len(keys), 1000):
+            client.delete_documents(documents=[{FIELDS_ID: key} for key in keys[start:start + 1000]])
+        return len(keys)
+
+    def search(self, index_name: str, query: str, k: int = 3) -> List[Document]:
+        return self.registry.get(index_name).similarity_search(
+            query=query, search_type="hybrid", k=k)
+
+    async def asearch(self, index_name: str, query: str, k: int = 3) -> List[Document]:
+        vector_store: Optional[AzureSearch] = self.registry.find(index_name)
+        if vector_store is None:
+            # AzureSearch の作成はインデックスの確認で通信を行うため、イベントループを止めないようにスレッドで実行する
+            vector_store = await asyncio.to_thread(self.registry.get, index_name)
+        return await vector_store.asimilarity_search(
+            query=query, search_type="hybrid", k=k)
+
+    def close(self, index_name: Optional[str] = None) -> None:
+        self.registry.close(index_name)
+
+
+class LocalIndex:
+    """
+    LocalVectorBackend の1つのインデックスです。
+    正規化した埋め込みを連続した float32 の行列として保持し、キーワード検索用の KeywordIndex を併せて持ちます。
+    """
+
+    def __init__(self, vectors: np.ndarray, documents: List[Document], ids: List[str], keywords: Optional[KeywordIndex] = None):
+        self.vectors = vectors
+        self.documents = documents
+        self.ids = ids
+        if keywords is None:
+            keywords = KeywordIndex()
+            keywords.add([document.page_content for document in documents])
+        # キーワードのインデックスはインデックスの更新後も共有し、追加したドキュメントのみを登録します
+        self.keywords = keywords
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+
+class LocalVectorBackend(VectorBackend):
+    """
+    プロセス内でベクトル検索を行うバックエンドです。
+    クラスや奨学金のデータのように小さなコーパスであれば、ネットワークを経由せずに検索できます。
+    Azure に接続できない環境でのテストの代わりとしても使用できます。
+
+    - 検索は、行列とクエリの埋め込みの内積 (コサイン類似度) で上位 k 件を求めます。
+    - ハイブリッド検索では、ベクトル検索と BM25 のキーワード検索のそれぞれ上位 candidates 件の順位を、
+      Reciprocal Rank Fusion (定数 rrf_k) で統合します。
+    - directory を指定した場合は、インデックスごとに埋め込み (vectors.npy) とドキュメント (documents.jsonl) を保存し、
+      埋め込みはメモリマップで読み込みます。
+    """
+
+    # インデックスと同じディレクトリの ParentStore から親の文章を取得する
+    inline_parents = False
+
+    def __init__(self, embeddings=None, directory: Optional[str] = None, candidates: int = 50, rrf_k: int = 60):
+        self.embeddings = embeddings or default_value.embeddings
+        self.directory = directory
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self._indexes: Dict[str, LocalIndex] = {}
+        self._lock = Lock()
+
+    def _index_path(self, index_name: str) -> str:
+        return os.path.join(self.directory, index_name)
+
+    def _load(self, index_name: str) -> LocalIndex:
+        # ロックを取得した状態で呼び出してください。
+        index = self._indexes.get(index_name)
+        if index is not None:
+            return index
+        vectors = np.empty((0, 0), dtype=np.float32)
+        documents: List[Document] = []
+        ids: List[str] = []
+        if self.directory and os.path.exists(os.path.join(self._index_path(index_name), "vectors.npy")):
+            path = self._index_path(index_name)
+            vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+            with open(os.path.join(path, "documents.jsonl"), encoding="utf-8") as f:
+                for line in f:
+                    row = json.loads(line)
+                    documents.append(Document(page_content=row["page_content"], metadata=row["metadata"]))
+                    ids.append(row.get("id") or uuid.uuid4().hex)
+        index = LocalIndex(vectors, documents, ids)
+        self._indexes[index_name] = index
+        return index
+
+    def _save(self, index_name: str, vectors: np.ndarray, documents: List[Document], ids: List[str]) -> np.ndarray:
+        # 一時ファイルに書き込んでから置き換え、読み込み中のメモリマップを壊さないようにします。
+        path = self._index_path(index_name)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "vectors.tmp.npy"), "wb") as f:
+            np.save(f, vectors)
+        with open(os.path.join(path, "documents.tmp.jsonl"), "w", encoding="utf-8") as f:
+            for id, document in zip(ids, documents):
+                f.write(json.dumps({"id": id, "page_content": document.page_content, "metadata": document.metadata}, ensure_ascii=False) + "\n")
+        os.replace(os.path.join(path, "vectors.tmp.npy"), os.path.join(path, "vectors.npy"))
+        os.replace(os.path.join(path, "documents.tmp.jsonl"), os.path.join(path, "documents.jsonl"))
+        return np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (vectors / norms).astype(np.float32)
+
+    def get_index(self, index_name: str) -> LocalIndex:
+        with self._lock:
+            return self._load(index_name)
+
+    def _replace(self, index_name: str, vectors: np.ndarray, documents: List[Document], ids: List[str], keywords: Optional[KeywordIndex] = None) -> None:
+        # ロックを取得した状態で呼び出してください。
+        # 検索中のスレッドが古いインデックスを参照し続けられるように、インデックスは置き換えます。
+        vectors = np.ascontiguousarray(vectors)
+        if self.directory:
+            vectors = self._save(index_name, vectors, documents, ids)
+        self._indexes[index_name] = LocalIndex(vectors, documents, ids, keywords)
+
+    def _remove(self, index: LocalIndex, ids: set) -> LocalIndex:
+        # ロックを取得した状態で呼び出してください。ids のドキュメントを除いたインデックスを返します。
+        keep = np.array([id not in ids for id in index.ids], dtype=bool)
+        if keep.all():
+            return index
+        # 削除した場合はドキュメント番号が変わるため、キーワードのインデックスは作り直します。
+        return LocalIndex(
+            np.ascontiguousarray(index.vectors[keep]),
+            [d for d, k in zip(index.documents, keep) if k],
+            [id for id, k in zip(index.ids, keep) if k])
+
+    def add_documents(self, index_name: str, documents: List[Document], ids: Optional[List[str]] = None) -> None:
+        if not documents:
+            return
+        ids = list(ids) if ids is not None else [uuid.uuid4().hex for _ in documents]
+        added = self._normalize(np.asarray(
+            self.embeddings.embed_documents([document.page_content for document in documents]), dtype=np.float32))
+        added_documents = [Document(page_content=d.page_content, metadata=dict(d.metadata)) for d in documents]
+        with self._lock:
+            loaded = self._load(index_name)
+            index = self._remove(loaded, set(ids))
+            vectors = np.vstack([index.vectors, added]) if len(index) else added
+            # 追加したドキュメントのみをキーワードのインデックスに登録します。
+            index.keywords.add([document.page_content for document in added_documents])
+            self._replace(index_name, vectors, index.documents + added_documents, index.ids + ids, index.keywords)
+
+    def delete_documents(self, index_name: str, ids: List[str]) -> None:
+        with self._lock:
+            loaded = self._load(index_name)
+            index = self._remove(loaded, set(ids))
+            if index is not loaded:
+                self._replace(index_name, index.vectors, index.documents, index.ids)
+
+    def count(self, index_name: str) -> int:
+        return len(self.get_index(index_name))
+
+    def clear(self, index_name: str) -> int:
+        with self._lock:
+            loaded = self._load(index_name)
+            if len(loaded):
+                self._replace(index_name, np.empty((0, 0), dtype=np.float32), [], [])
+            return len(loaded)
+
+    def search_by_vector(self, index_name: str, query: str, query_vector: List[float], k: int = 3) -> List[Document]:
+        index = self.get_index(index_name)
+        if not len(index):
+            return []
+        candidates = min(max(k, self.candidates), len(index))
+        scores = index.vectors @ self._normalize(np.asarray(query_vector, dtype=np.float32))
+        vector_ranking = np.argpartition(-scores, candidates - 1)[:candidates]
+        vector_ranking = vector_ranking[np.argsort(-scores[vector_ranking])]
+        # キーワードのインデックスは共有しているため、このインデックスのドキュメント数までを検索対象にします
+        keyword_ranking = [doc_id for doc_id, _ in index.keywords.search(query, candidates, limit=len(index))]
+        fused = reciprocal_rank_fusion([vector_ranking.tolist(), keyword_ranking], k=self.rrf_k)
+        return [index.documents[doc_id] for doc_id, _ in fused[:k]]
+
+    def search(self, index_name: str, query: str, k: int = 3) -> List[Document]:
+        return self.search_by_vector(index_name, query, self.embeddings.embed_query(query), k)
+
+    async def asearch(self, index_name: str, query: str, k: int = 3) -> List[Document]:
+        return self.search_by_vector(index_name, query, await self.embeddings.aembed_query(query), k)
+
+    def close(self, index_name: Optional[str] = None) -> None:
+        with self._lock:
+            if index_name is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(index_name, None)
+
+
+def create_vector_backend() -> VectorBackend:
+    """
+    環境変数 VECTOR_BACKEND に応じたバックエンドを作成します。
+    - azure (デフォルト): Azure AI Search
+    - local: LocalVectorBackend (LOCAL_VECTOR_DIR を指定した場合はそのディレクトリに保存)
+    """
+    backend = os.environ.get("VECTOR_BACKEND", "azure").lower()
+    if backend == "azure":
+        return AzureSearchBackend()
+    if backend == "local":
+        return LocalVectorBackend(directory=os.environ.get("LOCAL_VECTOR_DIR"))
+    raise ValueError(f"Unknown VECTOR_BACKEND: {backend}")
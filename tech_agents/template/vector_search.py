@@ -1,19 +1,114 @@
-from typing import List
+import os
+from typing import Awaitable, Callable, List, Optional
 from langchain_community.vectorstores.azuresearch import AzureSearch
 
 from tech_agents.template.models import Document
 from tech_agents.template import default_value
+from tech_agents.template.result_cache import QueryResultCache, SemanticResultCache
+from tech_agents.template.vector_backend import (
+    AzureSearchBackend,
+    VectorBackend,
+    VectorStoreRegistry,
+    create_vector_backend,
+)
 
 
-def dilect_vector(index_name, documents):  # ベクトルdata追加関数
-    vector_store: AzureSearch = AzureSearch(
-        azure_search_endpoint=default_value.vector_store_address,
-        azure_search_key=default_value.vector_store_password,
-        index_name=index_name,
-        embedding_function=default_value.embeddings.embed_query,
-    )
+# 検索に使用するバックエンド (環境変数 VECTOR_BACKEND で選択)
+vector_backend: VectorBackend = create_vector_backend()
+
+# プロセス全体で共有する AzureSearch のレジストリ
+if isinstance(vector_backend, AzureSearchBackend):
+    vector_stores = vector_backend.registry
+else:
+    vector_stores = VectorStoreRegistry()
+
+
+def get_vector_store(index_name: str) -> AzureSearch:  # 共有のベクトルストア取得関数
+    return vector_stores.get(index_name)
+
+
+def close_vector_stores(index_name: Optional[str] = None) -> None:  # 共有のベクトルストアを閉じる関数
+    vector_stores.close(index_name)
+    vector_backend.close(index_name)
+
+
+# 検索結果のキャッシュ
+# 意味的に近いクエリ (埋め込みのコサイン類似度が SEARCH_CACHE_THRESHOLD 以上) には、インデックスを検索せずにキャッシュした結果を返す
+search_results = SemanticResultCache(
+    threshold=float(os.environ.get("SEARCH_CACHE_THRESHOLD", "0.97")),
+    ttl_seconds=float(os.environ.get("SEARCH_CACHE_TTL_SECONDS", "600")),
+)
+# 埋め込みを使用しない検索 (キーワード検索) の結果のキャッシュ
+# 同じクエリ (正規化した文字列) には、インデックスを検索せずにキャッシュした結果を返す
+keyword_results = QueryResultCache(
+    ttl_seconds=float(os.environ.get("SEARCH_CACHE_TTL_SECONDS", "600")),
+)
+
+
+def cached_search(
+    index_name: str,
+    search_word: str,
+    k: int,
+    search: Callable[[], List[Document]]
+) -> List[Document]:  # 検索結果のキャッシュを使用する検索関数
+    query_vector = default_value.embeddings.embed_query(search_word)
+    res = search_results.get(index_name, query_vector, k)
+    if res is None:
+        res = search()
+        search_results.put(index_name, query_vector, k, res)
+    return res
+
+
+async def acached_search(
+    index_name: str,
+    search_word: str,
+    k: int,
+    search: Callable[[], Awaitable[List[Document]]]
+) -> List[Document]:  # cached_search の非同期版
+    query_vector = await default_value.embeddings.aembed_query(search_word)
+    res = search_results.get(index_name, query_vector, k)
+    if res is None:
+        res = await search()
+        search_results.put(index_name, query_vector, k, res)
+    return res
+
 
-    vector_store.add_documents(documents=documents)
+def cached_keyword_search(
+    index_name: str,
+    search_word: str,
+    k: int,
+    search: Callable[[], List[Document]]
+) -> List[Document]:  # クエリの文字列で検索結果をキャッシュする検索関数
+    # cached_search と異なり、クエリの埋め込みを作成しない
+    res = keyword_results.get(index_name, search_word, k)
+    if res is None:
+        res = search()
+        keyword_results.put(index_name, search_word, k, res)
+    return res
+
+
+async def acached_keyword_search(
+    index_name: str,
+    search_word: str,
+    k: int,
+    search: Callable[[], Awaitable[List[Document]]]
+) -> List[Document]:  # cached_keyword_search の非同期版
+    res = keyword_results.get(index_name, search_word, k)
+    if res is None:
+        res = await search()
+        keyword_results.put(index_name, search_word, k, res)
+    return res
+
+
+def invalidate_search_caches(index_name: Optional[str] = None) -> None:  # 検索結果のキャッシュ削除関数
+    # インデックスのデータを更新した場合に、意味的なキャッシュとクエリの文字列のキャッシュの両方を削除します。
+    search_results.invalidate(index_name)
+    keyword_results.invalidate(index_name)
+
+
+def dilect_vector(index_name, documents):  # ベクトルdata追加関数
+    vector_backend.add_documents(index_name, documents)
+    invalidate_search_caches(index_name)
 
 
 def search_vector(
@@ -21,13 +116,14 @@ def search_vector(
     search_word: str,
     k: int = 3
 ) -> List[Document]:  # ベクトル検索関数
-    index_name: str = index_name
-    vector_store: AzureSearch = AzureSearch(
-        azure_search_endpoint=default_value.vector_store_address,
-        azure_search_key=default_value.vector_store_password,
-        index_name=index_name,
-        embedding_function=default_value.embeddings.embed_query,
-    )
-    res = vector_store.similarity_search(
-        query=search_word, search_type="hybrid", k=k)
-    return res
+    return cached_search(
+        index_name, search_word, k, lambda: vector_backend.search(index_name, search_word, k))
+
+
+async def asearch_vector(
+    index_name: str,
+    search_word: str,
+    k: int = 3
+) -> List[Document]:  # 非同期のベクトル検索関数
+    return await acached_search(
+        index_name, search_word, k, lambda: vector_backend.asearch(index_name, search_word, k))
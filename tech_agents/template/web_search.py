@@ -0,0 +1,255 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from tech_agents.template.embedding_cache import normalize_embedding_text
+
+
+class WebSearchError(Exception):
+    # ウェブ検索に失敗した場合のエラー
+    pass
+
+
+def normalize_query(query: str) -> str:
+    # 全角・半角、大文字・小文字、空白の違いを吸収したキャッシュのキー
+    return normalize_embedding_text(query).lower()
+
+
+class SearchProvider:
+    """
+    WebSearchClient が使用する検索サービスの基底クラスです。
+    このクラスを継承して、search を実装してください。
+    """
+
+    def search(self, query: str) -> List[Dict[str, str]]:
+        # 検索結果を title・href・body の辞書のリストで返します。検索に失敗した場合は例外を送出します。
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def close(self) -> None:
+        pass
+
+
+class DuckDuckGoProvider(SearchProvider):
+    """
+    DuckDuckGo で検索する SearchProvider です。
+    クライアント (AsyncDDGS) は1つだけ作成し、専用のスレッドのイベントループで全ての検索に共有します。
+    """
+
+    def __init__(self, timeout: float = 10, max_results: int = 5, region: str = "wt-wt", backend: str = "api"):
+        self.timeout = timeout
+        self.max_results = max_results
+        self.region = region
+        self.backend = backend
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client = None
+        self._lock = Lock()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        # 最初に検索するときに、イベントループのスレッドとクライアントを作成する
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="duckduckgo-search", daemon=True).start()
+                    asyncio.run_coroutine_threadsafe(self._create_client(), loop).result()
+                    self._loop = loop
+        return self._loop
+
+    async def _create_client(self) -> None:
+        from duckduckgo_search import AsyncDDGS
+        self._client = AsyncDDGS(timeout=self.timeout)
+
+    async def _search(self, query: str) -> List[Dict[str, str]]:
+        return [
+            result async for result in self._client.text(
+                query, region=self.region, backend=self.backend, max_results=self.max_results)
+        ]
+
+    def search(self, query: str) -> List[Dict[str, str]]:
+        future = asyncio.run_coroutine_threadsafe(self._search(query), self._get_loop())
+        try:
+            # ページ送りで複数回のリクエストを行う場合があるため、待ち時間には余裕を持たせる
+            return future.result(timeout=self.timeout * 2)
+        except FutureTimeoutError as e:
+            future.cancel()
+            raise WebSearchError(f"{self.timeout * 2}秒以内に検索が終わりませんでした。") from e
+
+    def close(self) -> None:
+        with self._lock:
+            if self._loop is not None:
+                if self._client is not None:
+                    asyncio.run_coroutine_threadsafe(self._client.__aexit__(None, None, None), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+                self._client = None
+
+
+class FakeSearchProvider(SearchProvider):
+    """
+    テストや外部に接続できない環境で使用する SearchProvider です。
+    results に登録したクエリ (正規化したもの) にはその結果を、それ以外のクエリにはクエリを含む結果を1件返します。
+    delay 秒待ってから結果を返し、fail が True の場合は WebSearchError を送出します。
+    """
+
+    def __init__(self, results: Optional[Dict[str, List[Dict[str, str]]]] = None, delay: float = 0, fail: bool = False):
+        self.results = {normalize_query(query): value for query, value in (results or {}).items()}
+        self.delay = delay
+        self.fail = fail
+        self.calls: List[str] = []
+
+    def search(self, query: str) -> List[Dict[str, str]]:
+        self.calls.append(query)
+        time.sleep(self.delay)
+        if self.fail:
+            raise WebSearchError("FakeSearchProvider: fail")
+        return self.results.get(normalize_query(query), [
+            {"title": query, "href": "https://example.invalid/", "body": f"{query}についての検索結果です。"}
+        ])
+
+
+class TokenBucket:
+    """
+    トークンバケットによるレート制限です。
+    1秒あたり rate 個のトークンが、最大 capacity 個まで貯まります。acquire はトークンを1つ使用し、トークンがなければ貯まるまで待ちます。
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def _reserve(self) -> float:
+        # トークンを1つ予約し、使用できるまでの待ち時間を返します。
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, timeout: Optional[float] = None) -> None:
+        wait = self._reserve()
+        if timeout is not None and wait > timeout:
+            # 予約したトークンを戻す
+            with self._lock:
+                self._tokens += 1
+            raise WebSearchError(f"検索の回数が多いため、{wait:.1f}秒待つ必要があります。")
+        if wait:
+            time.sleep(wait)
+
+
+class WebSearchClient:
+    """
+    SearchProvider の検索結果をキャッシュし、検索の回数を制限するクライアントです。
+
+    - 正規化したクエリをキーに、検索結果を ttl_seconds 秒間、最大 max_entries 件キャッシュします。失敗した検索はキャッシュしません。
+    - 検索サービスへのリクエストは、TokenBucket で1秒あたり rate 回 (最大 burst 回まで連続) に制限し、max_wait 秒以上待つ場合は失敗とします。
+    - 同じクエリの検索が同時に実行された場合は、1回のリクエストの結果を共有します。
+    """
+
+    def __init__(
+        self,
+        provider: SearchProvider,
+        ttl_seconds: float = 3600,
+        max_entries: int = 1000,
+        rate: float = 1.0,
+        burst: float = 2,
+        max_wait: float = 30,
+    ):
+        self.provider = provider
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_wait = max_wait
+        self.rate_limiter = TokenBucket(rate, burst)
+        # キー -> (作成時刻, 検索結果)
+        self._entries: "OrderedDict[str, Tuple[float, List[Dict[str, str]]]]" = OrderedDict()
+        # キー -> 実行中の検索の結果
+        self._inflight: Dict[str, Future] = {}
+        self._lock = Lock()
+
+    def _cached(self, key: str) -> Optional[List[Dict[str, str]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _store(self, key: str, results: List[Dict[str, str]]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def search(self, query: str) -> List[Dict[str, str]]:
+        key = normalize_query(query)
+        results = self._cached(key)
+        if results is not None:
+            return results
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            # 同じクエリを検索中のスレッドの結果を待つ
+            return future.result()
+        try:
+            self.rate_limiter.acquire(timeout=self.max_wait)
+            results = self.provider.search(query)
+            self._store(key, results)
+            future.set_result(results)
+            return results
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    async def asearch(self, query: str) -> List[Dict[str, str]]:
+        results = self._cached(normalize_query(query))
+        if results is not None:
+            return results
+        return await asyncio.to_thread(self.search, query)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def close(self) -> None:
+        self.provider.close()
+
+
+def create_search_provider() -> SearchProvider:
+    """
+    環境変数 WEB_SEARCH_PROVIDER に応じた検索サービスを作成します。
+    - duckduckgo (デフォルト): DuckDuckGoProvider
+    - fake: FakeSearchProvider (外部に接続しません)
+    """
+    provider = os.environ.get("WEB_SEARCH_PROVIDER", "duckduckgo").lower()
+    if provider == "duckduckgo":
+        return DuckDuckGoProvider(timeout=float(os.environ.get("WEB_SEARCH_TIMEOUT_SECONDS", "10")))
+    if provider == "fake":
+        return FakeSearchProvider()
+    raise ValueError(f"Unknown WEB_SEARCH_PROVIDER: {provider}")
+
+
+# プロセス全体で共有するウェブ検索のクライアント
+web_search = WebSearchClient(
+    create_search_provider(),
+    ttl_seconds=float(os.environ.get("WEB_SEARCH_CACHE_TTL_SECONDS", "3600")),
+    rate=float(os.environ.get("WEB_SEARCH_RATE_PER_SECOND", "1")),
+)
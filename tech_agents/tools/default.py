@@ -56,11 +56,10 @@ class DefaultAgent(BaseToolAgent):
         super().__init__(llm, memory, chat_history, verbose)
         # DefaultAgent 特有の初期化（もしあれば）
 
-    def run(self, input):
+    def get_agent(self):
         # DefaultAgent特有の処理
-        default_agent = self.initialize_agent(
+        return self.initialize_agent(
             agent_type=AgentType.OPENAI_FUNCTIONS,
             tools=default_tools,  # 事前に定義されたdefault関数
             system_message_template=DEFAULT_SYSTEM_PROMPT
         )
-        return default_agent.run(input)
@@ -1,10 +1,22 @@
-from langchain.agents import AgentType, tool
+from langchain.agents import AgentType
+from langchain.tools import StructuredTool
+import asyncio
+import datetime
 import json
+import os
+import re
+import time
+import unicodedata
+from threading import Lock, Timer
+from typing import Dict, List, Optional, Tuple
+
 import requests
-import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pydantic.v1 import BaseModel, Field
 
 from tech_agents.template.agent_model import BaseToolAgent
+from tech_agents.template.date_parser import DAYS_IN_MONTH, find_dates, is_valid_date
 
 # システムプロンプトの設定
 # HOROSCOPE_SYSTEM_PROMPT = '''あなたは星占いの専門家です。
@@ -31,39 +43,237 @@ class HoroscopeInput(BaseModel) : # 誕生日を入力するためのモデル
     birthday: str = Field(
         description="'mm/dd'形式の誕生日です。例: 3月7日生まれの場合は '03/07' です。")
 
-@tool("horoscope", return_direct=True, args_schema=HoroscopeInput) # Agentsツールを作成。
-def horoscope(birthday: str): # 誕生日を入力すると、星占いをしてくれる関数を作成。
-    """星占いで今日の運勢を占います。"""
-    birthday = "02/28" if birthday == "02/29" else birthday
-    yday = datetime.datetime.strptime(birthday, '%m/%d').timetuple().tm_yday
-    sign_table = {
-        20: '山羊座', 50: '水瓶座', 81: '魚座', 111: '牡羊座',  142: '牡牛座',
-        174: '双子座', 205: '蟹座', 236: '獅子座',  267: '乙女座', 298: '天秤座',
-        328: '蠍座', 357: '射手座', 999: '山羊座',
-    }
-    for k, v in sign_table.items():
-        if yday < k:
-            sign = v
-            break
-
-    t_delta = datetime.timedelta(hours=9)
-    JST = datetime.timezone(t_delta, 'JST')
-    today = datetime.datetime.now(JST).strftime('%Y/%m/%d')
-    url = f"http://api.jugemkey.jp/api/horoscope/free/{today}"
-    response = requests.get(url)
-    horoscope = json.loads(response.text)["horoscope"][today]
-    horoscope = {h["sign"]: h for h in horoscope}
-    horoscope[sign]
+def build_sign_table() -> List[str]:  # うるう年の日ごとの星座の表を作成する関数
+    boundaries = [
+        (20, '山羊座'), (50, '水瓶座'), (81, '魚座'), (111, '牡羊座'), (142, '牡牛座'),
+        (174, '双子座'), (205, '蟹座'), (236, '獅子座'), (267, '乙女座'), (298, '天秤座'),
+        (328, '蠍座'), (357, '射手座'), (999, '山羊座'),
+    ]
+    table = []
+    for month, days in enumerate(DAYS_IN_MONTH, start=1):
+        for day in range(1, days + 1):
+            # 境界はうるう年でない年の通日で定義しているため、2月29日は2月28日と同じ星座とする
+            yday = datetime.date(2001, month, min(day, 28) if month == 2 else day).timetuple().tm_yday
+            table.append(next(sign for boundary, sign in boundaries if yday < boundary))
+    return table
+
+
+# うるう年の通日 (1月1日が0) ごとの星座 (366日分)
+SIGN_TABLE = build_sign_table()
+# 各月の1日の通日
+MONTH_OFFSETS = [sum(DAYS_IN_MONTH[:month]) for month in range(12)]
+
+
+def birthday_to_sign(birthday: str) -> str:  # 'mm/dd'形式の誕生日から星座を求める関数
+    month, day = (int(value) for value in birthday.split("/"))
+    if not is_valid_date(month, day):
+        raise ValueError(f"存在しない日付です: {birthday}")
+    return SIGN_TABLE[MONTH_OFFSETS[month - 1] + day - 1]
+
+
+# 誕生日であることを示す語と、日付だけの発言で日付以外に許す語
+_BIRTHDAY_CUE = re.compile(r"誕生|生まれ")
+_DATE_ONLY_REST = re.compile(r"[\s、。,.!?]*(?:です|だよ|だ)?[\s、。,.!?]*")
+
+
+def extract_birthday(text: str) -> Optional[str]:
+    """
+    ユーザーの発言から誕生日を 'mm/dd' 形式で返します。
+    「4月24日生まれ」「誕生日は4/24」のように誕生日であることが明らかな発言か、「4月24日です」のように日付だけの発言の場合に限ります。
+    それ以外 (「12月25日に会議」「4月24日の運勢」など)、日付がない場合、異なる日付が複数ある場合、存在しない日付の場合は、
+    誕生日が曖昧なため None を返します。
+    """
+    dates = find_dates(text)
+    if not dates or len({(month, day) for month, day, _, _ in dates}) != 1:
+        return None
+    month, day, _, _ = dates[0]
+    if not is_valid_date(month, day):
+        return None
+    normalized = unicodedata.normalize("NFKC", text)
+    if not _BIRTHDAY_CUE.search(normalized):
+        # 日付を除いた残りが句読点や「です」だけの場合は、誕生日を答えた発言として扱う
+        rest, position = [], 0
+        for _, _, start, end in dates:
+            rest.append(normalized[position:start])
+            position = end
+        rest.append(normalized[position:])
+        if not _DATE_ONLY_REST.fullmatch("".join(rest)):
+            return None
+    return f"{month:02d}/{day:02d}"
+
+
+# 占いのAPIのベースURL (テストではスタブサーバーのURLを指定する)
+HOROSCOPE_API_BASE = os.environ.get("HOROSCOPE_API_BASE", "http://api.jugemkey.jp/api/horoscope/free")
+JST = datetime.timezone(datetime.timedelta(hours=9), 'JST')
+
+
+def today_jst() -> str:  # 日本時間の今日の日付を 'yyyy/mm/dd' 形式で返す関数
+    return datetime.datetime.now(JST).strftime('%Y/%m/%d')
+
+
+def horoscope_url(day: Optional[str] = None):  # 占い結果を取得するURLを返す関数
+    day = day or today_jst()
+    return day, f"{HOROSCOPE_API_BASE.rstrip('/')}/{day}"
+
+
+def parse_horoscope(response_text: str, day: str) -> Dict[str, dict]:  # APIの応答を星座ごとの占い結果に変換する関数
+    horoscope = json.loads(response_text)["horoscope"][day]
+    return {h["sign"]: h for h in horoscope}
+
+
+def format_horoscope(horoscope: Dict[str, dict], sign: str, day: Optional[str] = None) -> str:  # 占い結果から回答を作成する関数
     content = \
     f'''今日の{sign}の運勢は...
     ・{horoscope[sign]["content"]}
     ・ラッキーアイテム:{horoscope[sign]["item"]}
     ・ラッキーカラー:{horoscope[sign]["color"]}'''
+    if day is not None and day != today_jst():
+        content += f"\n    ※今日の運勢を取得できなかったため、{day}の運勢です。"
     return content
 
 
+class HoroscopeCache:
+    """
+    占いのAPIの結果を日ごとにキャッシュするクラスです。
+    占い結果は日本時間の1日ごとに変わるため、1日1回だけAPIを呼び出し、全ての星座の結果をメモリから返します。
 
-horoscope_tools = [horoscope]
+    - HTTP の接続はセッションで再利用し、timeout 秒のタイムアウトと、一時的なエラーの再試行 (最大 retries 回) を行います。
+    - 最初に使用したときから、日本時間の0時過ぎに翌日の結果を先に取得します。
+    - APIから取得できない場合は、キャッシュにある最新の日 (前日) の結果を返します。取得に失敗した後 retry_interval 秒間はAPIを呼び出しません。
+    - 他のスレッドが取得している間は、前日の結果があればそれをすぐに返し、取得を待つのは前日の結果もない場合だけです。
+    """
+
+    def __init__(self, timeout: float = 5, retries: int = 3, retry_interval: float = 60, prefetch: bool = True):
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.prefetch = prefetch
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+        self.session.mount("http://", HTTPAdapter(max_retries=retry))
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+        # 日付 -> 星座 -> 占い結果
+        self._days: Dict[str, Dict[str, dict]] = {}
+        self._failed: Dict[str, float] = {}
+        self._lock = Lock()
+        self._fetch_lock = Lock()
+        self._timer: Optional[Timer] = None
+
+    def fetch(self, day: str) -> Dict[str, dict]:  # APIから占い結果を取得する関数
+        day, url = horoscope_url(day)
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return parse_horoscope(response.text, day)
+
+    def _latest(self, day: str) -> Optional[str]:
+        # day 以前でキャッシュにある最新の日付
+        days = [cached for cached in self._days if cached <= day]
+        return max(days) if days else None
+
+    def get(self, day: Optional[str] = None) -> Tuple[str, Dict[str, dict]]:
+        """
+        (占い結果の日付, 星座ごとの占い結果) を返します。
+        day の結果を取得できない場合は、キャッシュにある最新の日の結果を返します。キャッシュにもない場合は例外を送出します。
+        """
+        day = day or today_jst()
+        self._schedule()
+        with self._lock:
+            if day in self._days:
+                return day, self._days[day]
+            has_stale = self._latest(day) is not None
+        # 同じ日の取得は1回だけ行う。取得中に呼び出された場合、前日の結果があればそれを待たずに返し、なければ取得の完了を待つ
+        if self._fetch_lock.acquire(blocking=not has_stale):
+            try:
+                with self._lock:
+                    if day in self._days:
+                        return day, self._days[day]
+                    recently_failed = time.monotonic() - self._failed.get(day, -self.retry_interval) < self.retry_interval
+                if not recently_failed:
+                    try:
+                        horoscope = self.fetch(day)
+                    except Exception as e:
+                        print(f"占い結果を取得できませんでした: {e}")
+                        with self._lock:
+                            self._failed[day] = time.monotonic()
+                    else:
+                        with self._lock:
+                            self._days[day] = horoscope
+                            self._failed.pop(day, None)
+                            # 前日の結果は取得できない場合のために残し、それより古い結果は削除する
+                            for cached in sorted(self._days)[:-2]:
+                                del self._days[cached]
+                        return day, horoscope
+            finally:
+                self._fetch_lock.release()
+        with self._lock:
+            latest = self._latest(day)
+            if latest is None:
+                raise RuntimeError("占い結果を取得できませんでした。")
+            return latest, self._days[latest]
+
+    async def aget(self, day: Optional[str] = None) -> Tuple[str, Dict[str, dict]]:
+        day = day or today_jst()
+        with self._lock:
+            if day in self._days:
+                return day, self._days[day]
+        return await asyncio.to_thread(self.get, day)
+
+    def _schedule(self) -> None:
+        # 日本時間の次の0時過ぎに、その日の結果を取得するタイマーを設定する
+        if not self.prefetch or self._timer is not None:
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            now = datetime.datetime.now(JST)
+            midnight = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=5, microsecond=0)
+            self._timer = Timer((midnight - now).total_seconds(), self._prefetch)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _prefetch(self) -> None:
+        with self._lock:
+            self._timer = None
+        try:
+            self.get()
+        except Exception as e:
+            print(e)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.session.close()
+
+
+# プロセス全体で共有する占い結果のキャッシュ
+horoscope_cache = HoroscopeCache()
+
+
+def horoscope(birthday: str): # 誕生日を入力すると、星占いをしてくれる関数を作成。
+    """星占いで今日の運勢を占います。"""
+    sign = birthday_to_sign(birthday)
+    day, horoscope = horoscope_cache.get()
+    return format_horoscope(horoscope, sign, day)
+
+
+async def ahoroscope(birthday: str): # horoscope の非同期版
+    """星占いで今日の運勢を占います。"""
+    sign = birthday_to_sign(birthday)
+    day, horoscope = await horoscope_cache.aget()
+    return format_horoscope(horoscope, sign, day)
+
+
+horoscope_tool = StructuredTool.from_function( # Agentsツールを作成。
+    func=horoscope,
+    coroutine=ahoroscope,
+    name="horoscope",
+    args_schema=HoroscopeInput,
+    return_direct=True
+)
+
+
+horoscope_tools = [horoscope_tool]
 
 
 class HoroscopeAgentInput(BaseModel):
@@ -78,11 +288,23 @@ class HoroscopeAgent(BaseToolAgent):
         # HoroscopeAgent 特有の初期化（もしあれば）
 
     def run(self, input):
+        # 誕生日が明らかな場合は、LLM を呼び出さずに占い結果を返す
+        birthday = extract_birthday(input)
+        if birthday is None:
+            return super().run(input)
+        return self.finish_turn(input, horoscope(birthday))
+
+    async def arun(self, input):
+        birthday = extract_birthday(input)
+        if birthday is None:
+            return await super().arun(input)
+        return self.finish_turn(input, await ahoroscope(birthday))
+
+    def get_agent(self):
         # HoroscopeAgent特有の処理
-        horoscope_agent = self.initialize_agent(
+        return self.initialize_agent(
             agent_type=AgentType.OPENAI_FUNCTIONS,
             tools=horoscope_tools,  # 事前に定義されたhoroscope関数
             system_message_template=HOROSCOPE_SYSTEM_PROMPT
         )
-        return horoscope_agent.run(input)
 
@@ -2,6 +2,7 @@ from langchain.agents import Tool
 from pydantic.v1 import BaseModel, Field
 
 from tech_agents.template.agent_model import BaseDispatcherAgent
+from tech_agents.template.pre_router import RouteRule
 from tech_agents.tools import procedure
 
 
@@ -34,6 +35,7 @@ class ProcedureAgent(BaseDispatcherAgent):
         procedure_agent_tools = [
             Tool.from_function(
                 func=self.late_notification_agent.run,
+                coroutine=self.late_notification_agent.arun,
                 name="late_notification",
                 # description="この担当者は遅延届申請を受け付けている担当者。ユーザーが遅延届を届け出たい場合はこの担当者に任せる。",
                 description="This person is responsible for accepting late report requests. If a user wants to report a delay, this is the person to contact.",
@@ -42,6 +44,7 @@ class ProcedureAgent(BaseDispatcherAgent):
             ),
             Tool.from_function(
                 func=self.official_absence_agent.run,
+                coroutine=self.official_absence_agent.arun,
                 name="official_absence",
                 # description="この担当者は公欠届申請を受け付けている担当者。ユーザーが公欠届を届け出たい場合はこの担当者に任せる。"
                 description="This person is responsible for accepting public absence requests. If the user wants to report a public absence, this person will be in charge.",
@@ -57,3 +60,10 @@ class ProcedureAgent(BaseDispatcherAgent):
             ),
         ]
         return procedure_agent_tools
+
+    def define_routes(self):
+        # LLM を使わずに振り分けるキーワードの定義
+        return [
+            RouteRule("late_notification", keywords=["遅延届", "遅延証明", "電車の遅延", "遅延"]),
+            RouteRule("official_absence", keywords=["公欠"]),
+        ]
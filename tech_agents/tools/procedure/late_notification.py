@@ -7,6 +7,7 @@ import datetime
 from pydantic.v1 import BaseModel, Field
 
 from tech_agents.template.agent_model import BaseToolAgent
+from tech_agents.template.memory import end_procedure
 
 # システムプロンプトの設定
 # 日本語ver
@@ -156,6 +157,7 @@ def late_notification_items(
 ) -> str:
     """遅延届の申請を行う関数です。"""
     if canceled:
+        end_procedure()
         return "わかりました。また各種申請が必要になったらご相談ください。"
 
     def check_params(date, late_class, in_class_time, late_class_name, late_class_instructor, use_public_transportation, use_transportation_name, late_time):
@@ -232,6 +234,8 @@ def late_notification_items(
         return response
 
     if has_required and confirmed and check_late_time:
+        # 申請が完了したら手続きを終了する
+        end_procedure()
         return request_late_notification(date, late_class, in_class_time, late_class_name, late_class_instructor, use_public_transportation, use_transportation_name, late_time)
     else:
         if has_required and check_late_time:
@@ -262,14 +266,18 @@ class LateNotificationAgentInput(BaseModel): # 遅延届に関するAgentの入
 
 
 class LateNotificationAgent(BaseToolAgent):
+    # 申請の手続きは複数ターンにわたるため、手続きの実行中はルーターを通さずにこのエージェントへ振り分ける
+    procedure_name = "late_notification"
+    # 手続きの外で呼び出された場合も、会話履歴は制限せずに渡す
+    history_budget = None
+
     def __init__(self, llm, memory, chat_history, verbose):
         super().__init__(llm, memory, chat_history, verbose)
     
-    def run(self, input):
+    def get_agent(self):
         # LateNotificationAgent特有の処理
-        late_notification_agent = self.initialize_agent(
+        return self.initialize_agent(
             agent_type=AgentType.OPENAI_FUNCTIONS,
             tools=late_notification_items_tools,  # 事前に定義されたlate_notification_items関数
             system_message_template=LATE_NOTIFICATION_ITEMS_SYSTEM_PROMPT
         )
-        return late_notification_agent.run(input)
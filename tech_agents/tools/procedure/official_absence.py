@@ -7,6 +7,7 @@ import datetime
 from pydantic.v1 import BaseModel, Field
 
 from tech_agents.template.agent_model import BaseToolAgent
+from tech_agents.template.memory import end_procedure
 from tech_agents.tools.procedure.late_notification import get_todays_date
 
 
@@ -149,6 +150,7 @@ def application_items(
 ) -> str:
     """公欠届の申請を行う関数です。"""
     if canceled:
+        end_procedure()
         return "わかりました。また各種申請が必要になったらご相談ください。"
 
     def check_params(date, application_class, reason):
@@ -236,6 +238,8 @@ def application_items(
         return response
 
     if has_required and confirmed:
+        # 申請が完了したら手続きを終了する
+        end_procedure()
         return request_official_absence(date, application_class, reason)
     else:
         if has_required:
@@ -255,15 +259,19 @@ class OfficialAbsenceAgentInput(BaseModel): # 公欠届に関するAgentの入
 
 
 class OfficialAbsenceAgent(BaseToolAgent):
+    # 申請の手続きは複数ターンにわたるため、手続きの実行中はルーターを通さずにこのエージェントへ振り分ける
+    procedure_name = "official_absence"
+    # 手続きの外で呼び出された場合も、会話履歴は制限せずに渡す
+    history_budget = None
+
     def __init__(self, llm, memory, chat_history, verbose):
         super().__init__(llm, memory, chat_history, verbose)
         # OfficialAbsenceAgent 特有の初期化（もしあれば）
 
-    def run(self, input):
+    def get_agent(self):
         # OfficialAbsenceAgent特有の処理
-        official_absence_agent = self.initialize_agent(
+        return self.initialize_agent(
             agent_type=AgentType.OPENAI_FUNCTIONS,
             tools=application_items_tools,  # 事前に定義されたapplication_items関数
             system_message_template=APPLICATION_ITEMS_SYSTEM_PROMPT
         )
-        return official_absence_agent.run(input)
@@ -1,8 +1,9 @@
 from pydantic.v1 import BaseModel, Field
-from langchain_community.tools import DuckDuckGoSearchRun
 from langchain_core.prompts import ChatPromptTemplate
 from langchain.prompts.chat import MessagesPlaceholder, SystemMessagePromptTemplate, ChatPromptTemplate
 
+from tech_agents.template.web_search import web_search
+
 
 prompt = ChatPromptTemplate.from_messages([
     ("system", "Summarize the text you give next into a form that fits the user's question. summary: {summary}"),
@@ -11,6 +12,14 @@ prompt = ChatPromptTemplate.from_messages([
 
 
 
+SEARCH_FAILED_MESSAGE = '検索に失敗しました。時間をおいてから再度お試しください。'
+SEARCH_NOT_FOUND_MESSAGE = '検索結果が見つかりませんでした。検索ワードを変えてお試しください。'
+
+
+def format_search_results(results):  # 検索結果の本文をつなげる関数
+    return " ".join(result["body"] for result in results if result.get("body"))
+
+
 class DDGSearchInput(BaseModel):  # 検索ワードを入力するためのモデルを作成。
     search_word: str = Field(description="ユーザーからの入力から生成される検索ワードです。")
 
@@ -27,18 +36,35 @@ class DDGSearchAgent:
         chain = prompt | self.llm
         inputs = {"summary": summary, "input": input}
         return chain.invoke(inputs).content
+
+    async def asummary(self, summary, input):
+        chain = prompt | self.llm
+        inputs = {"summary": summary, "input": input}
+        return (await chain.ainvoke(inputs)).content
     
     def ddg_search(self, input):
-        ddg_search = DuckDuckGoSearchRun()
+        # 検索結果の本文をつなげて返す。検索に失敗した場合は例外を送出する
+        return format_search_results(web_search.search(input))
+
+    async def addg_search(self, input):
+        return format_search_results(await web_search.asearch(input))
+
+    def run(self, input):
         try:
-            return ddg_search.run(input)
+            search_text = self.ddg_search(input)
         except Exception as e:
             print(e)
-            return f'検索に失敗しました。時間をおいてから再度お試しください。'
-    
-    def run(self, input):
-        search_text = self.ddg_search(input)
-        if search_text == '検索に失敗しました。時間をおいてから再度お試しください。':
-            return search_text
-        else:
-            return self.summary(summary=search_text, input=input)
+            return SEARCH_FAILED_MESSAGE
+        if not search_text:
+            return SEARCH_NOT_FOUND_MESSAGE
+        return self.summary(summary=search_text, input=input)
+
+    async def arun(self, input):
+        try:
+            search_text = await self.addg_search(input)
+        except Exception as e:
+            print(e)
+            return SEARCH_FAILED_MESSAGE
+        if not search_text:
+            return SEARCH_NOT_FOUND_MESSAGE
+        return await self.asummary(summary=search_text, input=input)
@@ -2,6 +2,7 @@ from langchain.agents import Tool
 from pydantic.v1 import BaseModel, Field
 
 from tech_agents.template.agent_model import BaseDispatcherAgent
+from tech_agents.template.pre_router import RouteRule
 from tech_agents.tools import search
 
 class SearchAgentInput(BaseModel):
@@ -39,6 +40,7 @@ class SearchAgent(BaseDispatcherAgent):
         search_agent_tools = [
             Tool.from_function(
                 func=self.school_agent.run,
+                coroutine=self.school_agent.arun,
                 name="school_agent",
                 # description="この担当者は京都テックという名前の学校の受付担当者。京都テックについて聞かれた場合や専攻等について聞かれた場合はこの担当者に任せる。", # 日本語ver
                 description="This person is the receptionist for the school named Kyoto Tech. If you are asked about Kyoto Tech, your major, etc., leave it to this person.",  # 英語ver
@@ -47,6 +49,7 @@ class SearchAgent(BaseDispatcherAgent):
             ),
             Tool.from_function(
                 func=self.class_agent.run,
+                coroutine=self.class_agent.arun,
                 name="class_agent",
                 # description="この担当者は学校の先生をまとめる担当者。授業のことについてや技術的な質問について聞かれた場合はこの担当者に任せる。", # 日本語ver
                 description="This person is in charge of organizing the teachers at the school. If you are asked about a class or about technical questions, this person is in charge.",  # 英語ver
@@ -55,6 +58,7 @@ class SearchAgent(BaseDispatcherAgent):
             ),
             Tool.from_function(
                 func=self.scholarship_agent.run,
+                coroutine=self.scholarship_agent.arun,
                 name="scholarship_agent",
                 # description="この担当者は奨学金についての相談受付担当者。奨学金について聞かれた場合はこの担当者に任せる。", # 日本語ver
                 description="This person is the person in charge of counseling about the scholarship. If you are asked about scholarships, this person will be your contact person.",  # 英語ver
@@ -63,6 +67,7 @@ class SearchAgent(BaseDispatcherAgent):
             ),
             Tool.from_function(
                 func=self.ddg_search.run,
+                coroutine=self.ddg_search.arun,
                 name="DuckDuckGoSearchRun",
                 description="This person is in charge of conducting searches using search engines. If an Internet search is required, this person is in charge of the search.",
                 return_direct=True
@@ -76,3 +81,12 @@ class SearchAgent(BaseDispatcherAgent):
             ),
         ]
         return search_agent_tools
+
+    def define_routes(self):
+        # LLM を使わずに振り分けるキーワードの定義
+        return [
+            RouteRule("scholarship_agent", keywords=["奨学金", "給付型", "貸与型"]),
+            RouteRule("class_agent", keywords=["授業", "シラバス", "講義", "カリキュラム"]),
+            RouteRule("school_agent", keywords=["京都テック", "学科", "専攻", "入学", "キャンパス"]),
+            RouteRule("DuckDuckGoSearchRun", keywords=["ネットで", "インターネット", "ウェブで", "web検索", "ニュース"]),
+        ]
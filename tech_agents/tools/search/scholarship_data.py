@@ -1,8 +1,10 @@
 from pydantic.v1 import BaseModel, Field
-from langchain.agents import AgentType, tool
+from langchain.agents import AgentType
+from langchain.tools import StructuredTool
 
 from tech_agents.template.agent_model import BaseToolAgent
-from tech_agents.template.vector_search import search_vector
+from tech_agents.template.retrieval import assemble_context
+from tech_agents.template.vector_search import asearch_vector, search_vector
 
 # システムプロンプトの設定
 # SEARCHDB_SYSTEM_PROMPT = '''あなたはデータベース検索AIです。
@@ -43,31 +45,50 @@ Then, conduct a search using the keyword 'Kyoto Tech,' create a response based o
 # エージェントの初期化
 
 
+# 検索するインデックスの名前
+INDEX_NAME = "vector-scholarship-data"
+# 検索するチャンクの件数と、回答に使用する分割元の文章の最大件数
+# 複数のチャンクが同じ分割元の文章にまとめられるため、チャンクは多めに検索する
+SEARCH_K = 6
+MAX_PASSAGES = 3
+
+
 class SearchInput(BaseModel):  # 検索ワードを入力するためのモデルを作成。
     search_word: str = Field(description="ユーザーからの入力から生成される検索ワードです。")
 
 
-@tool("search", args_schema=SearchInput)  # Agentsツールを作成。
+def format_search_result(docs):  # 検索結果を回答用の形式に変換する関数
+    docs = [doc for doc in docs if hasattr(doc, 'metadata')]
+    # 同じ分割元の文章を重複して渡さないように、分割元の文章ごとにまとめる
+    sources = assemble_context(INDEX_NAME, docs, max_passages=MAX_PASSAGES)
+    search_result = []
+    for i, source in enumerate(sources, start=1):
+        search_result.append(
+            f'・検索結果{i}は以下の通りです。\n{source}\n\n')
+    return search_result
+
+
 def search(
     search_word: str,
 ):
     """検索ワードから、検索結果を返答します。"""
-    def search_database(search_word):
-        docs = search_vector("vector-scholarship-data", search_word)
-        i = 1
-        search_result = []
-        for doc in docs:
-            if hasattr(doc, 'metadata'):
-                search_result.append(
-                    f'・検索結果{i}は以下の通りです。\n{doc.metadata["split_source"]}\n\n')
-                i += 1
-        return search_result
+    docs = search_vector(INDEX_NAME, search_word, k=SEARCH_K)
+    return format_search_result(docs)
+
+
+async def asearch(
+    search_word: str,
+):
+    """検索ワードから、検索結果を返答します。"""
+    docs = await asearch_vector(INDEX_NAME, search_word, k=SEARCH_K)
+    return format_search_result(docs)
+
 
-    serach_result = search_database(search_word)
-    return serach_result
+search_tool = StructuredTool.from_function(  # Agentsツールを作成。
+    func=search, coroutine=asearch, name="search", args_schema=SearchInput)
 
 
-search_tools = [search]
+search_tools = [search_tool]
 
 
 class ScholarshipAgentInput(BaseModel):
@@ -81,11 +102,10 @@ class ScholarshipAgent(BaseToolAgent):
         super().__init__(llm, memory, chat_history, verbose)
         # ScholarshipAgent 特有の初期化（もしあれば）
 
-    def run(self, input):
+    def get_agent(self):
         # ScholarshipAgent特有の処理
-        scholarship_agent = self.initialize_agent(
+        return self.initialize_agent(
             agent_type=AgentType.OPENAI_FUNCTIONS,
             tools=search_tools,  # 事前に定義されたsearch関数
             system_message_template=SEARCHDB_SYSTEM_PROMPT
         )
-        return scholarship_agent.run(input)
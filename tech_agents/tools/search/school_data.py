@@ -2,11 +2,13 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-from langchain.agents import AgentType, tool
+from langchain.agents import AgentType
+from langchain.tools import StructuredTool
 from langchain_community.retrievers import AzureCognitiveSearchRetriever
 from pydantic.v1 import BaseModel, Field
 
 from tech_agents.template.agent_model import BaseToolAgent
+from tech_agents.template.vector_search import acached_keyword_search, cached_keyword_search
 
 
 # システムプロンプトの設定
@@ -49,33 +51,55 @@ Then, conduct a search using the keyword 'Kyoto Tech,' create a response based o
 class SearchInput(BaseModel) : # 検索ワードを入力するためのモデルを作成。
     search_word: str = Field(description="ユーザーからの入力から生成される検索ワードです。")
 
-@tool("search", args_schema=SearchInput) # Agentsツールを作成。
+TOP_K = 3
+
+
+def create_retriever():  # 学校データの検索を行う Retriever を作成する関数
+    return AzureCognitiveSearchRetriever(
+        service_name=os.environ["AZURE_COGNITIVE_SEARCH_SERVICE_NAME"],
+        index_name=os.environ["AZURE_COGNITIVE_SEARCH_INDEX_NAME"],
+        api_key=os.environ["AZURE_SEARCH_KEY"],
+        content_key="content",
+        top_k=TOP_K
+    )
+
+
+def format_search_result(res):  # 検索結果を回答用の形式に変換する関数
+    i = 1
+    search_result = []
+    for doc in res:
+        if hasattr(doc, 'page_content'):
+            search_result.append(f'・検索結果{i}は以下の通りです。\n{doc.page_content}\n\n')
+            i += 1
+    return search_result
+
+
 def search(
     search_word: str,
 ):
     """検索ワードから、検索結果を返答します。"""
-    def search_database(search_word):
-        retriever = AzureCognitiveSearchRetriever(
-            service_name=os.environ["AZURE_COGNITIVE_SEARCH_SERVICE_NAME"],
-            index_name=os.environ["AZURE_COGNITIVE_SEARCH_INDEX_NAME"],
-            api_key=os.environ["AZURE_SEARCH_KEY"],
-            content_key="content",
-            top_k=3
-        )
-        res = retriever.get_relevant_documents(query=search_word)
-        i = 1
-        search_result = []
-        for doc in res:
-            if hasattr(doc, 'page_content'):
-                search_result.append(f'・検索結果{i}は以下の通りです。\n{doc.page_content}\n\n')
-                i += 1
-        return search_result
+    # キーワード検索のため、クエリの埋め込みを作成しないキャッシュを使用する
+    res = cached_keyword_search(
+        os.environ["AZURE_COGNITIVE_SEARCH_INDEX_NAME"], search_word, TOP_K,
+        lambda: create_retriever().get_relevant_documents(query=search_word))
+    return format_search_result(res)
+
+
+async def asearch(
+    search_word: str,
+):
+    """検索ワードから、検索結果を返答します。"""
+    res = await acached_keyword_search(
+        os.environ["AZURE_COGNITIVE_SEARCH_INDEX_NAME"], search_word, TOP_K,
+        lambda: create_retriever().aget_relevant_documents(query=search_word))
+    return format_search_result(res)
+
 
-    serach_result = search_database(search_word)
-    return serach_result
+search_tool = StructuredTool.from_function( # Agentsツールを作成。
+    func=search, coroutine=asearch, name="search", args_schema=SearchInput)
 
 
-search_tools = [search]
+search_tools = [search_tool]
 
 
 
@@ -89,12 +113,11 @@ class SchoolAgent(BaseToolAgent):
         super().__init__(llm, memory, chat_history, verbose)
         # SchoolAgent 特有の初期化（もしあれば）
 
-    def run(self, input):
+    def get_agent(self):
         # SchoolAgent特有の処理
-        school_agent = self.initialize_agent(
+        return self.initialize_agent(
             agent_type=AgentType.OPENAI_FUNCTIONS,
             tools=search_tools,  # 事前に定義されたsearch関数
             system_message_template=SEARCHDB_SYSTEM_PROMPT
         )
-        return school_agent.run(input)
 
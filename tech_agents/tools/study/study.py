@@ -1,7 +1,8 @@
-from langchain.agents import AgentType, tool
+from langchain.agents import AgentType
+from langchain.tools import StructuredTool
 from pydantic.v1 import BaseModel, Field
 
-from tech_agents.template.vector_search import search_vector
+from tech_agents.template.vector_search import asearch_vector, search_vector
 from tech_agents.template.agent_model import BaseToolAgent
 
 
@@ -32,8 +33,7 @@ Respond in Japanese.
 '''
 
 
-def search_database(study_input):
-    docs = search_vector("vector-class-data", study_input)
+def format_search_result(docs):
     i = 1
     search_result = []
     for doc in docs:
@@ -45,26 +45,52 @@ def search_database(study_input):
         i += 1
     return search_result
 
+
+def search_database(study_input):
+    docs = search_vector("vector-class-data", study_input)
+    return format_search_result(docs)
+
+
+async def asearch_database(study_input):
+    docs = await asearch_vector("vector-class-data", study_input)
+    return format_search_result(docs)
+
+
+def format_study_result(search_result):
+    if len(search_result) == 0:
+        return "該当する内容は見つかりませんでした。"
+    else:
+        return "\n".join(search_result)
+
 # エージェントの初期化
 class StudyInput(BaseModel):  
     study_input: str = Field(
         description="データベースに検索するための入力です。")
 
 
-@tool("study", return_direct=False, args_schema=StudyInput)  # Agentsツールを作成。
 def study(study_input: str):  
     """授業データベースにアクセスし、検索結果を返答します。"""
     try:
         search_result = search_database(study_input)
     except Exception as e:
         return "検索に失敗しました。"
-    if len(search_result) == 0:
-        return "該当する内容は見つかりませんでした。"
-    else:
-        return "\n".join(search_result)
+    return format_study_result(search_result)
+
+
+async def astudy(study_input: str):  
+    """授業データベースにアクセスし、検索結果を返答します。"""
+    try:
+        search_result = await asearch_database(study_input)
+    except Exception as e:
+        return "検索に失敗しました。"
+    return format_study_result(search_result)
+
+
+study_tool = StructuredTool.from_function(  # Agentsツールを作成。
+    func=study, coroutine=astudy, name="study", return_direct=False, args_schema=StudyInput)
 
 
-study_tools = [study]
+study_tools = [study_tool]
 
 
 class StudyAgentInput(BaseModel):
@@ -76,10 +102,9 @@ class StudyAgent(BaseToolAgent):
     def __init__(self, llm, memory, chat_history, verbose):
         super().__init__(llm, memory, chat_history, verbose)
 
-    def run(self, input):
-        study_agent = self.initialize_agent(
+    def get_agent(self):
+        return self.initialize_agent(
             agent_type=AgentType.OPENAI_FUNCTIONS,
             tools=study_tools,  
             system_message_template=STUDY_SYSTEM_PROMPT
         )
-        return study_agent.run(input)
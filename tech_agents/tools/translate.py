@@ -2,6 +2,8 @@ from langchain.prompts.chat import MessagesPlaceholder, SystemMessagePromptTempl
 
 from pydantic.v1 import BaseModel, Field
 
+from tech_agents.template.memory import HistoryBudget, load_history, resolve_memory
+
 
 # プロンプトの設定
 # DEFAULT_SYSTEM_PROMPT = '''あなたは会話型アシスタントエージェントです。
@@ -46,6 +48,9 @@ class TranslateAgentInput(BaseModel):
 
 
 class TranslateAgent:
+    # 翻訳には直近の会話のみを参照する
+    history_budget: HistoryBudget = HistoryBudget(max_turns=2, max_tokens=1000)
+
     def __init__(self, llm, memory, chat_history, verbose):
         self.llm = llm
         self.memory = memory
@@ -53,9 +58,16 @@ class TranslateAgent:
         self.verbose = verbose
 
     def run(self, input):
-        history = self.memory.load_memory_variables({})['chat_history']
         transrate_chain = translate_prompt | self.llm
-        inputs = {"chat_history": history, "input": input}
-        result = transrate_chain.invoke(inputs)
+        result = transrate_chain.invoke(self.prepare_inputs(input))
+        return result.content
+
+    async def arun(self, input):
+        transrate_chain = translate_prompt | self.llm
+        result = await transrate_chain.ainvoke(self.prepare_inputs(input))
         return result.content
 
+    def prepare_inputs(self, input):
+        history = load_history(resolve_memory(self.memory), self.history_budget)['chat_history']
+        return {"chat_history": history, "input": input}
+
@@ -0,0 +1,140 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from typing import List, Optional
+
+from tech_agents.template import default_value
+from tech_agents.template.embedding_cache import CachedEmbeddings
+
+
+# スロットリングや一時的なエラーとして再試行する HTTP ステータス
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class EmbeddingReport:  # 埋め込みの作成結果の集計クラス
+    def __init__(self):
+        self.chunks = 0
+        self.tokens = 0
+        self.cached = 0
+        self.requests = 0
+        self.retries = 0
+        self.elapsed = 0.0
+        self._lock = Lock()
+
+    def record_batch(self, batch: List[str], retries: int) -> None:
+        with self._lock:
+            self.chunks += len(batch)
+            self.tokens += sum(approximate_tokens(text) for text in batch)
+            self.requests += 1
+            self.retries += retries
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.chunks / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.chunks}件 ({self.tokens}トークン) を {self.requests}回のリクエストで {self.elapsed:.1f}秒 "
+            f"({self.chunks_per_second:.1f}件/秒, {self.tokens_per_second:.0f}トークン/秒, "
+            f"再試行 {self.retries}回, キャッシュ済み {self.cached}件)"
+        )
+
+
+def approximate_tokens(text: str) -> int:
+    # 文字数によるトークン数の概算 (日本語はおおよそ1文字1トークン)
+    return len(text)
+
+
+def batch_texts(texts: List[str], max_batch_tokens: int = 8000, max_batch_size: int = 16) -> List[List[str]]:
+    # 1回のリクエストで送るテキストを、トークン数と件数の上限に収まるようにまとめます。
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    batch_tokens = 0
+    for text in texts:
+        tokens = approximate_tokens(text)
+        if batch and (batch_tokens + tokens > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def is_retryable(error: Exception) -> bool:
+    # openai のスロットリング (RateLimitError) や一時的なサーバーエラーかどうか
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code in RETRY_STATUS_CODES or type(error).__name__ in ("RateLimitError", "APITimeoutError", "APIConnectionError")
+
+
+def retry_delay(error: Exception, attempt: int, base_delay: float, max_delay: float) -> float:
+    # Retry-After ヘッダーがあればそれに従い、なければ指数バックオフ (ジッター付き) で待ち時間を決めます。
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    retry_after = headers.get("retry-after") if hasattr(headers, "get") else None
+    if retry_after:
+        try:
+            return min(float(retry_after), max_delay)
+        except ValueError:
+            pass
+    return min(base_delay * (2 ** attempt), max_delay) * (0.5 + random.random() / 2)
+
+
+def embed_batch(embeddings, batch: List[str], max_retries: int, base_delay: float, max_delay: float, report: EmbeddingReport) -> List[List[float]]:
+    attempt = 0
+    while True:
+        try:
+            vectors = embeddings.embed_documents(batch)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            time.sleep(retry_delay(e, attempt, base_delay, max_delay))
+            attempt += 1
+            continue
+        report.record_batch(batch, attempt)
+        return vectors
+
+
+def embed_concurrently(
+    texts: List[str],
+    embeddings=None,
+    cache: Optional[CachedEmbeddings] = None,
+    max_batch_tokens: int = 8000,
+    max_batch_size: int = 16,
+    max_workers: int = 4,
+    max_retries: int = 6,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+    report: Optional[EmbeddingReport] = None,
+) -> EmbeddingReport:
+    """
+    テキストの埋め込みを、まとめたリクエストを並行に送って作成し、埋め込みのキャッシュに保存します。
+    キャッシュに保存した埋め込みは、その後の add_documents でインデックスに登録するときに再利用されます。
+
+    - テキストはトークン数 max_batch_tokens、件数 max_batch_size を上限に1回のリクエストにまとめます。
+    - 最大 max_workers 個のリクエストを並行に送ります。
+    - スロットリングされた場合は、最大 max_retries 回まで指数バックオフで再試行します。
+    - 作成した件数・トークン数・秒あたりのスループットを EmbeddingReport で返します。report を渡した場合は集計を追加します。
+    """
+    embeddings = embeddings or default_value.batch_embeddings_model
+    cache = cache or default_value.embeddings
+    report = report or EmbeddingReport()
+    missing = cache.uncached(texts)
+    report.cached += len(texts) - len(missing)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(embed_batch, embeddings, batch, max_retries, base_delay, max_delay, report): batch
+            for batch in batch_texts(missing, max_batch_tokens, max_batch_size)
+        }
+        for future in as_completed(futures):
+            cache.store(futures[future], future.result())
+    report.elapsed += time.perf_counter() - start
+    return report
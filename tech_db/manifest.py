@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Set
+
+from tech_db.models import Document
+
+
+def default_manifest_dir() -> str:
+    # ローカルのインデックスを使用する場合は、インデックスと同じディレクトリに保存する
+    return os.environ.get("INDEX_MANIFEST_DIR") or os.environ.get("LOCAL_VECTOR_DIR") or ".index_manifest"
+
+
+def row_hash(doc: Document) -> str:  # データの内容のハッシュを求める関数
+    metadata = {key: value for key, value in doc.metadata.items() if key != "source_id"}
+    content = doc.page_content + "\n" + json.dumps(metadata, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def source_id(doc: Document) -> str:  # データの行を識別するIDを返す関数
+    # 行のIDがない場合は内容のハッシュで識別する (内容が変わった場合は削除と追加として扱われる)
+    value = doc.metadata.get("source_id")
+    return str(value) if value is not None else row_hash(doc)
+
+
+def chunk_id(index_name: str, source: str, position: int, content: str) -> str:  # チャンクのIDを求める関数
+    # 同じ行の同じ位置に同じ内容のチャンクがあれば、同じIDになる
+    # チャンクのIDには、本文とメタデータのハッシュ (row_hash) を content として渡す
+    key = f"{index_name}\n{source}\n{position}\n{content}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:40]
+
+
+def parent_id(index_name: str, source: str, position: int, content: str) -> str:  # 親の文章のIDを求める関数
+    # チャンクのIDと区別するため、キーに "parent" を含める
+    return chunk_id(index_name, source, position, "parent\n" + content)
+
+
+class IndexManifest:
+    """
+    インデックスに登録済みのデータの記録です。
+    行ごとに、内容のハッシュと登録したチャンクのIDを保持します。
+    add_vector はこの記録と比較して、追加・変更された行のチャンクのみを登録し、削除された行のチャンクを削除します。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # 行のID -> {"hash": 内容のハッシュ, "chunks": [チャンクのID]}
+        self.rows: Dict[str, dict] = {}
+
+    @classmethod
+    def load(cls, index_name: str, directory: Optional[str] = None) -> "IndexManifest":
+        manifest = cls(os.path.join(directory or default_manifest_dir(), f"{index_name}.manifest.json"))
+        if os.path.exists(manifest.path):
+            with open(manifest.path, encoding="utf-8") as f:
+                manifest.rows = json.load(f)["rows"]
+        return manifest
+
+    def exists(self) -> bool:
+        # 記録が保存されているか (初めての実行では False)
+        return os.path.exists(self.path)
+
+    def clear(self) -> None:
+        # 全ての行の記録を削除します。インデックスを空にして登録し直す場合に使用します。
+        self.rows = {}
+
+    def save(self) -> None:
+        # 一時ファイルに書き込んでから置き換え、途中で失敗しても記録が壊れないようにする
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"rows": self.rows}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def is_changed(self, row: Document) -> bool:
+        # 記録にない行、または内容が変わった行かどうか
+        entry = self.rows.get(source_id(row))
+        return entry is None or entry["hash"] != row_hash(row)
+
+    def removed(self, seen: Set[str]) -> List[str]:
+        # seen (今回読み込んだ行のID) にない、削除された行のIDを返す
+        return [source for source in self.rows if source not in seen]
+
+    def chunks(self, source: str) -> List[str]:
+        entry = self.rows.get(source)
+        return list(entry["chunks"]) if entry is not None else []
+
+    def update(self, source: str, hash: str, chunks: List[str]) -> None:
+        self.rows[source] = {"hash": hash, "chunks": chunks}
+
+    def remove(self, source: str) -> List[str]:
+        # 行の記録を削除し、登録していたチャンクのIDを返す
+        entry = self.rows.pop(source, None)
+        return list(entry["chunks"]) if entry is not None else []
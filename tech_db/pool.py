@@ -0,0 +1,156 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from queue import Empty, LifoQueue
+from threading import BoundedSemaphore
+from typing import Any, Callable, Iterator, Optional
+
+
+class PoolTimeoutError(Exception):
+    # 接続プールの全ての接続が使用中で、timeout 秒以内に接続を取得できなかった場合のエラー
+    pass
+
+
+class PooledConnection:
+    # プールが管理する接続と、作成時刻・最後に返却された時刻
+    def __init__(self, connection: Any):
+        self.connection = connection
+        self.created = time.monotonic()
+        self.released = self.created
+
+
+class ConnectionPool:
+    """
+    データベースの接続を再利用する接続プールです。
+    接続のたびに発生する TLS とログインのハンドシェイクを避けるため、返却された接続を保持して次の操作で使用します。
+
+    - 同時に使用できる接続は最大 max_size 個です。全て使用中の場合は timeout 秒まで返却を待ちます。
+    - 作成から recycle_seconds 秒が経過した接続は、取得時に閉じて作り直します。
+    - health_check_seconds 秒以上使用されていなかった接続は、取得時に health_check_query を実行して確認し、失敗した場合は作り直します。
+    - transaction のブロック内で transaction を呼び出した場合は、外側のトランザクションのカーソルを返します。
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        max_size: int = 5,
+        recycle_seconds: Optional[float] = 1800,
+        health_check_seconds: Optional[float] = 30,
+        health_check_query: str = "SELECT 1",
+        timeout: float = 30,
+    ):
+        self.connect = connect
+        self.max_size = max_size
+        self.recycle_seconds = recycle_seconds
+        self.health_check_seconds = health_check_seconds
+        self.health_check_query = health_check_query
+        self.timeout = timeout
+        self._idle: "LifoQueue[PooledConnection]" = LifoQueue()
+        self._slots = BoundedSemaphore(max_size)
+        # transaction のブロック内で使用中のカーソル
+        self._current_cursor: ContextVar[Optional[Any]] = ContextVar(f"current_cursor_{id(self)}", default=None)
+
+    def _expired(self, pooled: PooledConnection) -> bool:
+        return self.recycle_seconds is not None and time.monotonic() - pooled.created > self.recycle_seconds
+
+    def _healthy(self, pooled: PooledConnection) -> bool:
+        if self.health_check_seconds is None or time.monotonic() - pooled.released < self.health_check_seconds:
+            return True
+        try:
+            cursor = pooled.connection.cursor()
+            try:
+                cursor.execute(self.health_check_query)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(pooled: PooledConnection) -> None:
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+
+    def acquire(self) -> PooledConnection:
+        # 接続を取得します。使用後は必ず release で返却してください。
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeoutError(f"{self.timeout}秒以内にデータベースの接続を取得できませんでした。(最大 {self.max_size} 接続)")
+        try:
+            while True:
+                try:
+                    pooled = self._idle.get_nowait()
+                except Empty:
+                    return PooledConnection(self.connect())
+                if not self._expired(pooled) and self._healthy(pooled):
+                    return pooled
+                self._close(pooled)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, pooled: PooledConnection, discard: bool = False) -> None:
+        # 接続を返却します。discard が True の場合や、確定していない変更を取り消せない場合は接続を閉じます。
+        try:
+            if not discard and not self._expired(pooled):
+                try:
+                    pooled.connection.rollback()
+                except Exception:
+                    discard = True
+            else:
+                discard = True
+            if discard:
+                self._close(pooled)
+            else:
+                pooled.released = time.monotonic()
+                self._idle.put(pooled)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        # 接続を取得し、ブロックを抜けるときに返却します。確定していない変更は返却時に取り消します。
+        pooled = self.acquire()
+        try:
+            yield pooled.connection
+        finally:
+            self.release(pooled)
+
+    @contextmanager
+    def transaction(self) -> Iterator[Any]:
+        """
+        ブロック内の操作を1つのトランザクションで実行します。
+        ブロックを正常に抜けた場合はコミットし、例外が発生した場合はロールバックします。
+        ブロック内で transaction を使用する関数は、このトランザクションのカーソルを使用します。既にトランザクション中の場合は、外側のトランザクションに含めます。
+        """
+        current = self._current_cursor.get()
+        if current is not None:
+            yield current
+            return
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            token = self._current_cursor.set(cursor)
+            try:
+                yield cursor
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._current_cursor.reset(token)
+                cursor.close()
+
+    def active_cursor(self) -> Optional[Any]:
+        # transaction のブロック内であればそのカーソルを、そうでなければ None を返します。
+        return self._current_cursor.get()
+
+    def close(self) -> None:
+        # 保持している未使用の接続を閉じます。
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except Empty:
+                return
+            self._close(pooled)
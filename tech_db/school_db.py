@@ -1,71 +1,71 @@
-import os
 from dotenv import load_dotenv
-from typing import List
-import pyodbc
+from threading import Lock
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from tech_db.models import Document
+from tech_db.storage import InsertReport, StorageBackend, create_storage_backend, parse_metadata
 
 
 load_dotenv(override=True)
 
-server = os.environ.get('db_host')
-database = os.environ.get('db_name')
-username = os.environ.get('db_user')
-password = os.environ.get('db_pas')
-driver = '{ODBC Driver 18 for SQL Server}'
+_storage: Optional[StorageBackend] = None
+_storage_lock = Lock()
 
 
+def get_storage() -> StorageBackend:  # データベース取得関数
+    # 接続情報は環境変数 STORAGE_BACKEND に応じて、最初に使用するときに読み込む
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage_backend()
+    return _storage
 
 
-def create_table(table_name):  # テーブル作成関数
-    with pyodbc.connect('DRIVER='+driver+';SERVER=tcp:'+server+';PORT=1433;DATABASE='+database+';UID='+username+';PWD=' + password) as conn:
-        with conn.cursor() as cursor:
-            query = f'''
-                CREATE TABLE {table_name}
-                (
-                    id int IDENTITY(1,1) PRIMARY KEY,
-                    data NVARCHAR(MAX) NOT NULL,
-                    metadata NVARCHAR(MAX) NULL
-                )
-            '''
+def set_storage(storage: StorageBackend) -> None:  # データベース設定関数
+    global _storage
+    with _storage_lock:
+        if _storage is not None:
+            _storage.close()
+        _storage = storage
+
 
-            cursor.execute(query)
-            cursor.commit()
+def transaction():  # トランザクション関数
+    """
+    ブロック内の school_db の操作を1つのトランザクションで実行します。
+    例: with transaction(): insert_data(...); insert_data(...)
+    """
+    return get_storage().transaction()
 
 
+def create_table(table_name):  # テーブル作成関数
+    get_storage().create_table(table_name)
+
 
 def insert_data(table_name, data, metadata):  # データ挿入関数
-    with pyodbc.connect('DRIVER='+driver+';SERVER=tcp:'+server+';PORT=1433;DATABASE='+database+';UID='+username+';PWD=' + password) as conn:
-        with conn.cursor() as cursor:
-            query = f'''
-                INSERT INTO {table_name} (data, metadata)
-                VALUES (?, ?)
-            '''
-            cursor.execute(query, data, str(metadata))
-            cursor.commit()
+    get_storage().insert_data(table_name, data, metadata)
 
 
-def select_data(table_name) -> List[Document]:  # データ取得関数
-    with pyodbc.connect('DRIVER='+driver+';SERVER=tcp:'+server+';PORT=1433;DATABASE='+database+';UID='+username+';PWD=' + password) as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                f'SELECT TOP (1000) * FROM [dbo].[{table_name}]')
-            row = cursor.fetchone()
-            contexts = []
-            while row:
-                # 存在する属性にアクセスする前にチェック
-                if hasattr(row, 'id') and hasattr(row, 'data') and hasattr(row, 'metadata'):
-                    metadata = eval(row.metadata)
-                    doc = Document(row.data, metadata)
-                    contexts.append(doc)
-                row = cursor.fetchone()
-    return contexts
+def insert_many(table_name, rows: Iterable[Tuple[str, dict]], chunk_size: int = 1000) -> InsertReport:  # データ一括挿入関数
+    """
+    (データ, メタデータ) の組をまとめてテーブルに挿入します。
+    rows はジェネレーターでも構いません。chunk_size 行ずつまとめて送信してコミットするため、全ての行をメモリに保持しません。
+    transaction のブロック内で呼び出した場合は、ブロックの終わりにまとめてコミットします。
+    """
+    return get_storage().insert_many(table_name, rows, chunk_size)
 
 
-def drop_table(table_name):
-    with pyodbc.connect('DRIVER='+driver+';SERVER=tcp:'+server+';PORT=1433;DATABASE='+database+';UID='+username+';PWD=' + password) as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(f'DROP TABLE {table_name}')
-            cursor.commit()
+def iter_data(table_name, page_size: int = 500) -> Iterator[Document]:  # データ取得関数 (ジェネレーター)
+    """
+    テーブルの全ての行を、id の順に page_size 行ずつ取得して Document として返します。
+    前のページの最後の id より大きい行を取得する (キーセットページング) ため、大きなテーブルでも一定のメモリで読み込めます。
+    """
+    return get_storage().iter_data(table_name, page_size)
+
 
+def select_data(table_name) -> List[Document]:  # データ取得関数
+    return get_storage().select_data(table_name)
 
+
+def drop_table(table_name):
+    get_storage().drop_table(table_name)
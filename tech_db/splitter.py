@@ -0,0 +1,74 @@
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from typing import ContextManager, Iterator, List, Optional, Tuple
+
+from tech_db.models import Document, JapaneseCharacterTextSplitter
+from tech_db.manifest import parent_id, source_id
+
+
+# 分割に使用するプロセス数 (デフォルトの 1 の場合は呼び出し元のプロセスで分割する)
+# 2 以上にする場合、Windows・macOS では add_vector を呼び出すスクリプトで if __name__ == "__main__": が必要です。
+SPLIT_WORKERS = int(os.environ.get("SPLIT_WORKERS", "1"))
+
+# 回答に使用する親の文章の分割
+parent_splitter = JapaneseCharacterTextSplitter(
+    chunk_size=300,
+    chunk_overlap=50,
+)
+# 埋め込みを作成するチャンクの分割
+child_splitter = JapaneseCharacterTextSplitter(
+    chunk_size=50,
+    chunk_overlap=10,
+)
+
+# (親のID, 行のID, 親の文章) のリストと、チャンクのリスト
+SplitResult = Tuple[List[Tuple[str, str, str]], List[Document]]
+
+
+def split_document(index_name: str, doc: Document, inline_parents: bool = False) -> SplitResult:  # 1行の分割関数
+    # 行を親の文章に分割し、親の文章をさらにチャンクに分割する。チャンクには親の文章ではなく parent_id を持たせる
+    # inline_parents が True の場合は、ParentStore を使用できない検索側のために親の文章 (split_source) も持たせる
+    source = source_id(doc)
+    parents = []
+    chunks = []
+    for position, parent in enumerate(parent_splitter.split_text(doc.page_content)):
+        id = parent_id(index_name, source, position, parent)
+        parents.append((id, source, parent))
+        metadata = {**doc.metadata, 'parent_id': id}
+        if inline_parents:
+            metadata['split_source'] = parent
+        for child in child_splitter.split_text(parent):
+            chunks.append(Document(child, dict(metadata)))
+    return parents, chunks
+
+
+class SplitExecutor(ProcessPoolExecutor):
+    # split_data がプロセス数から受け渡しの単位を決めるために、プロセス数を保持するプロセスプール
+
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers=max_workers)
+        self.max_workers = max_workers
+
+
+def split_executor(max_workers: Optional[int] = None) -> ContextManager[Optional[Executor]]:  # 分割用のプロセスプール作成関数
+    # プロセス数が1の場合は None を返し、split_data は呼び出し元のプロセスで分割する
+    max_workers = max_workers or SPLIT_WORKERS
+    if max_workers <= 1:
+        return nullcontext()
+    return SplitExecutor(max_workers)
+
+
+def split_data(index_name: str, documents: List[Document], executor: Optional[Executor] = None, inline_parents: bool = False) -> Iterator[SplitResult]: # データ分割関数
+    """
+    行ごとに (親の文章, チャンク) を、documents と同じ順に返します。
+    executor を指定した場合は、複数のプロセスで並列に分割し、分割が終わった行から順に返します。
+    """
+    split = partial(split_document, index_name, inline_parents=inline_parents)
+    if executor is None:
+        return map(split, documents)
+    # プロセス間の受け渡しの回数を減らすため、行をまとめて渡す
+    # SplitExecutor 以外の executor ではプロセス数が分からないため、SPLIT_WORKERS で見積もる
+    workers = getattr(executor, "max_workers", None) or SPLIT_WORKERS
+    return executor.map(split, documents, chunksize=max(1, len(documents) // (workers * 4)))
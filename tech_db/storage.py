@@ -0,0 +1,296 @@
+import ast
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+from tech_db.models import Document
+from tech_db.pool import ConnectionPool
+
+
+class InsertReport:  # 一括挿入の結果の集計クラス
+    def __init__(self):
+        self.rows = 0
+        self.commits = 0
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        # 外側のトランザクション中に挿入した場合は、コミットの回数は 0 になる
+        commits = f"{self.commits}回のコミットで" if self.commits else "外側のトランザクションで"
+        return f"{self.rows}行を {commits} {self.elapsed:.1f}秒 ({self.rows_per_second:.0f}行/秒)"
+
+
+def parse_metadata(text) -> dict:  # メタデータの文字列を辞書に変換する関数
+    # insert_data は str(dict) で保存するため、JSON として読めない場合は Python のリテラルとして安全に評価する
+    if not text:
+        return {}
+    try:
+        metadata = json.loads(text)
+    except ValueError:
+        try:
+            metadata = ast.literal_eval(text)
+        except (ValueError, SyntaxError) as e:
+            print(f"メタデータを読み込めませんでした: {e}")
+            return {}
+    return metadata if isinstance(metadata, dict) else {}
+
+
+def row_document(id, data: str, metadata) -> Document:  # 行を Document に変換する関数
+    metadata = parse_metadata(metadata)
+    # 差分の登録で行を識別するために、行のIDをメタデータに加える
+    metadata.setdefault('source_id', id)
+    return Document(data, metadata)
+
+
+def chunked(rows: Iterable[Tuple[str, dict]], chunk_size: int) -> Iterator[List[Tuple[str, dict]]]:
+    iterator = iter(rows)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class StorageBackend:
+    """
+    school_db が使用する、データを保存するデータベースの基底クラスです。
+    テーブルは id (自動採番の主キー)・data (テキスト)・metadata (メタデータの文字列) の3列で構成されます。
+    このクラスを継承して、transaction・create_table・insert_many・iter_data・drop_table を実装してください。
+    """
+
+    def transaction(self):
+        # ブロック内の操作を1つのトランザクションで実行し、カーソルを返すコンテキストマネージャーを返します。
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def create_table(self, table_name: str) -> None:
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def insert_data(self, table_name: str, data: str, metadata: dict) -> None:
+        self.insert_many(table_name, [(data, metadata)])
+
+    def insert_many(self, table_name: str, rows: Iterable[Tuple[str, dict]], chunk_size: int = 1000) -> InsertReport:
+        # (データ, メタデータ) の組を chunk_size 行ずつ挿入してコミットします。
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def iter_data(self, table_name: str, page_size: int = 500) -> Iterator[Document]:
+        # テーブルの全ての行を id の順に page_size 行ずつ取得して返します。
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def select_data(self, table_name: str) -> List[Document]:
+        return list(self.iter_data(table_name))
+
+    def drop_table(self, table_name: str) -> None:
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def close(self) -> None:
+        pass
+
+
+class PooledStorageBackend(StorageBackend):
+    """
+    ConnectionPool で接続を再利用する StorageBackend です。
+    トランザクションとキーセットページング・一括挿入の処理を共通化し、SQL の方言はサブクラスで指定します。
+    """
+
+    def __init__(self, connect: Callable[[], Any], max_size: int = 5, recycle_seconds: Optional[float] = 1800):
+        self.pool = ConnectionPool(connect, max_size=max_size, recycle_seconds=recycle_seconds)
+
+    def transaction(self):
+        return self.pool.transaction()
+
+    def create_table_query(self, table_name: str) -> str:
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def page_query(self, table_name: str) -> str:
+        # id が前のページの最後の id より大きい行を、id の順に最大 page_size 行取得する SQL を返します。
+        raise NotImplementedError(
+            "This method should be implemented by subclasses.")
+
+    def page_params(self, page_size: int, last_id: int) -> tuple:
+        return (page_size, last_id)
+
+    def table_name(self, table_name: str) -> str:
+        return table_name
+
+    def format_metadata(self, metadata: dict) -> str:
+        return str(metadata)
+
+    @contextmanager
+    def prepare_insert(self, cursor) -> Iterator[None]:
+        # 一括挿入の間だけカーソルの設定を変更する場合に、サブクラスで変更して元に戻します。
+        yield
+
+    def create_table(self, table_name: str) -> None:
+        with self.transaction() as cursor:
+            cursor.execute(self.create_table_query(table_name))
+
+    def insert_many(self, table_name: str, rows: Iterable[Tuple[str, dict]], chunk_size: int = 1000) -> InsertReport:
+        query = f'INSERT INTO {self.table_name(table_name)} (data, metadata) VALUES (?, ?)'
+        report = InsertReport()
+        # 外側のトランザクション中の場合は、ブロックの終わりにまとめてコミットされるため、コミットの回数に数えない
+        owns_transaction = self.pool.active_cursor() is None
+        start = time.perf_counter()
+        for chunk in chunked(rows, chunk_size):
+            with self.transaction() as cursor, self.prepare_insert(cursor):
+                cursor.executemany(query, [(data, self.format_metadata(metadata)) for data, metadata in chunk])
+            report.rows += len(chunk)
+            if owns_transaction:
+                report.commits += 1
+        report.elapsed = time.perf_counter() - start
+        return report
+
+    def iter_data(self, table_name: str, page_size: int = 500) -> Iterator[Document]:
+        cursor = self.pool.active_cursor()
+        if cursor is not None:
+            # トランザクション中であれば、そのトランザクションで読み込む
+            yield from self._iter_pages(cursor, table_name, page_size)
+            return
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield from self._iter_pages(cursor, table_name, page_size)
+            finally:
+                cursor.close()
+
+    def _iter_pages(self, cursor, table_name: str, page_size: int) -> Iterator[Document]:
+        # 前のページの最後の id より大きい行を取得する (キーセットページング) ため、大きなテーブルでも一定のメモリで読み込めます。
+        query = self.page_query(table_name)
+        # id は1から採番されるため、0 より大きい行から読み込む
+        last_id = 0
+        while True:
+            cursor.execute(query, self.page_params(page_size, last_id))
+            rows = cursor.fetchall()
+            for id, data, metadata in rows:
+                yield row_document(id, data, metadata)
+            if len(rows) < page_size:
+                break
+            last_id = rows[-1][0]
+
+    def drop_table(self, table_name: str) -> None:
+        with self.transaction() as cursor:
+            cursor.execute(f'DROP TABLE {self.table_name(table_name)}')
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+class PyodbcBackend(PooledStorageBackend):
+    """
+    SQL Server (ODBC Driver 18) にデータを保存する StorageBackend です。
+    接続情報を省略した場合は、最初に接続するときに環境変数 db_host・db_name・db_user・db_pas から読み込みます。
+    """
+
+    def __init__(self, connection_string: Optional[str] = None, max_size: int = 5, recycle_seconds: Optional[float] = 1800):
+        self.connection_string = connection_string
+        super().__init__(self.connect, max_size=max_size, recycle_seconds=recycle_seconds)
+
+    @staticmethod
+    def default_connection_string() -> str:
+        driver = '{ODBC Driver 18 for SQL Server}'
+        return ('DRIVER=' + driver + ';SERVER=tcp:' + os.environ['db_host'] + ';PORT=1433;DATABASE=' + os.environ['db_name']
+                + ';UID=' + os.environ['db_user'] + ';PWD=' + os.environ['db_pas'])
+
+    def connect(self):
+        # SQLite だけを使用する環境では pyodbc と ODBC ドライバーが不要なため、接続するときに読み込む
+        import pyodbc
+        return pyodbc.connect(self.connection_string or self.default_connection_string())
+
+    def create_table_query(self, table_name: str) -> str:
+        return f'''
+            CREATE TABLE {table_name}
+            (
+                id int IDENTITY(1,1) PRIMARY KEY,
+                data NVARCHAR(MAX) NOT NULL,
+                metadata NVARCHAR(MAX) NULL
+            )
+        '''
+
+    def page_query(self, table_name: str) -> str:
+        return f'SELECT TOP (?) id, data, metadata FROM [dbo].[{table_name}] WHERE id > ? ORDER BY id'
+
+    @contextmanager
+    def prepare_insert(self, cursor) -> Iterator[None]:
+        # パラメーターを1行ずつではなく、配列にまとめてサーバーに送信する
+        # 外側のトランザクションのカーソルを共有している場合があるため、挿入の後に元の設定に戻す
+        previous = cursor.fast_executemany
+        cursor.fast_executemany = True
+        try:
+            yield
+        finally:
+            cursor.fast_executemany = previous
+
+
+class SQLiteBackend(PooledStorageBackend):
+    """
+    SQLite のファイルにデータを保存する StorageBackend です。
+    小規模な環境や CI で、リモートのデータベースなしにデータの登録から検索までを実行するために使用します。
+
+    - WAL モードで開き、読み込みと書き込みを並行に実行できるようにします。
+    - SQL はパラメーター付きの同じ文を使用し、sqlite3 のステートメントキャッシュで準備済みの文を再利用します。
+    - メタデータは JSON で保存し、JSON1 の json_valid で検証します。json_extract で検索条件に使用できます。
+    """
+
+    def __init__(self, path: str = "school.db", max_size: int = 5, busy_timeout: float = 30):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        # SQLite の接続は作成が軽いため、作り直しは行わない
+        super().__init__(self.connect, max_size=max_size, recycle_seconds=None)
+
+    def connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False, cached_statements=256)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def table_name(self, table_name: str) -> str:
+        return '"' + table_name.replace('"', '""') + '"'
+
+    def format_metadata(self, metadata: dict) -> str:
+        return json.dumps(metadata, ensure_ascii=False, default=str)
+
+    def create_table_query(self, table_name: str) -> str:
+        return f'''
+            CREATE TABLE {self.table_name(table_name)}
+            (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data TEXT NOT NULL,
+                metadata TEXT NULL CHECK (metadata IS NULL OR json_valid(metadata))
+            )
+        '''
+
+    def page_query(self, table_name: str) -> str:
+        return f'SELECT id, data, metadata FROM {self.table_name(table_name)} WHERE id > ? ORDER BY id LIMIT ?'
+
+    def page_params(self, page_size: int, last_id: int) -> tuple:
+        return (last_id, page_size)
+
+
+def create_storage_backend() -> StorageBackend:
+    """
+    環境変数 STORAGE_BACKEND に応じたバックエンドを作成します。
+    - sqlserver (デフォルト): PyodbcBackend (SQL Server)
+    - sqlite: SQLiteBackend (SQLITE_DB_PATH のファイル、省略した場合は school.db)
+    """
+    max_size = int(os.environ.get('DB_POOL_SIZE', 5))
+    backend = os.environ.get("STORAGE_BACKEND", "sqlserver").lower()
+    if backend == "sqlserver":
+        return PyodbcBackend(max_size=max_size, recycle_seconds=float(os.environ.get('DB_POOL_RECYCLE_SECONDS', 1800)))
+    if backend == "sqlite":
+        return SQLiteBackend(os.environ.get("SQLITE_DB_PATH", "school.db"), max_size=max_size)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
@@ -1,107 +1,157 @@
 import os
 from dotenv import load_dotenv
 load_dotenv(override=True)
-from typing import Any, List
+from itertools import islice
+from concurrent.futures import Executor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 import logging
 
 from langchain_community.vectorstores.azuresearch import AzureSearch
 from langchain_openai import OpenAIEmbeddings
 from langchain.text_splitter import CharacterTextSplitter, RecursiveCharacterTextSplitter
 
-from tech_db.school_db import select_data
+from tech_db.school_db import iter_data, select_data
 from tech_db.models import Document, JapaneseCharacterTextSplitter
+from tech_db.splitter import split_data, split_executor
+from tech_db.embedding import EmbeddingReport, embed_concurrently
+from tech_db.manifest import IndexManifest, chunk_id, row_hash, source_id
 from tech_agents.template import default_value
+from tech_agents.template.parent_store import parent_store
+from tech_agents.template.vector_search import dilect_vector, get_vector_store, invalidate_search_caches, search_vector, vector_backend
 
 
+# 1回の埋め込みの作成・インデックスへの登録で扱う件数
+INGEST_BATCH_SIZE = 1000
+
 
 def get_contexts(table_name): # データベースからの取得関数
     sql_data = select_data(table_name)
     return sql_data
 
 
-def split_data(documents: List[Document]) -> List[Document]: # データ分割関数
-    first_text_splitter = JapaneseCharacterTextSplitter(
-        chunk_size=300,
-        chunk_overlap=50,
-    )
-    second_text_splitter = JapaneseCharacterTextSplitter(
-        chunk_size=50,
-        chunk_overlap=10,
-    )
-
-    first_text_split_result = first_text_splitter.split_documents(documents)
-    
-    for doc in first_text_split_result:
-        doc.metadata['split_source'] = doc.page_content
-        
-    second_text_split_result = second_text_splitter.split_documents(first_text_split_result)
-    
-    return second_text_split_result
-
-
-
-def add_vector(table_name): # ベクトルdata追加関数
+def assign_chunk_ids(index_name: str, chunks: List[Document]) -> List[str]: # チャンクのID付与関数
+    # 行ごとのチャンクの位置と内容から、実行のたびに同じになるIDを求める
+    # 内容にはメタデータ (parent_id を含む) も含め、行のメタデータや親の文章が変わった場合は別のIDとして登録し直す
+    positions: Dict[str, int] = {}
+    ids = []
+    for chunk in chunks:
+        source = source_id(chunk)
+        position = positions.get(source, 0)
+        positions[source] = position + 1
+        ids.append(chunk_id(index_name, source, position, row_hash(chunk)))
+    return ids
+
+
+def batched(iterable: Iterable[Document], size: int) -> Iterator[List[Document]]: # 分割取得関数
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def update_rows(index_name: str, manifest: IndexManifest, rows: List[Document], report: EmbeddingReport, executor: Optional[Executor] = None) -> None: # 行の登録関数
+    # 追加・変更された行を分割して埋め込み、インデックスに登録して記録を更新する
+    parents: List[Tuple[str, str, str]] = []
+    documents: List[Document] = []
+    for row_parents, chunks in split_data(index_name, rows, executor, inline_parents=vector_backend.inline_parents):
+        parents.extend(row_parents)
+        documents.extend(chunks)
+    ids = assign_chunk_ids(index_name, documents)
+
+    # 行ごとの新しいチャンクのIDと、登録済みのチャンクのIDを比較する
+    new_chunks: Dict[str, List[str]] = {}
+    for doc, id in zip(documents, ids):
+        new_chunks.setdefault(source_id(doc), []).append(id)
+    registered = set()
+    stale_ids: List[str] = []
+    for row in rows:
+        source = source_id(row)
+        old_chunks = manifest.chunks(source)
+        registered.update(old_chunks)
+        stale_ids.extend(set(old_chunks) - set(new_chunks.get(source, [])))
+    added = [(doc, id) for doc, id in zip(documents, ids) if id not in registered]
+
+    # 親の文章は、チャンクを登録する前に保存する
+    if not vector_backend.inline_parents:
+        parent_store.put(index_name, parents)
+    if stale_ids:
+        vector_backend.delete_documents(index_name, stale_ids)
+    # 埋め込みはまとめて並行に作成してキャッシュし、インデックスへの登録時に再利用する
+    if added:
+        embed_concurrently([doc.page_content for doc, _ in added], report=report)
+        vector_backend.add_documents(index_name, [doc for doc, _ in added], ids=[id for _, id in added])
+
+    # 登録が終わってから、使用されなくなった親の文章を削除する
+    if not vector_backend.inline_parents:
+        new_parents: Dict[str, List[str]] = {source_id(row): [] for row in rows}
+        for id, source, _ in parents:
+            new_parents[source].append(id)
+        parent_store.remove_stale(index_name, new_parents)
+
+    for row in rows:
+        source = source_id(row)
+        manifest.update(source, row_hash(row), new_chunks.get(source, []))
+    print(f"{len(rows)}行を登録しました。追加 {len(added)}件, 削除 {len(stale_ids)}件")
+
+
+def add_vector(table_name, rebuild: bool = False): # ベクトルdata追加関数
+    """
+    テーブルのデータをインデックスに登録します。
+    前回の登録内容 (IndexManifest) と比較し、追加・変更された行のチャンクのみを埋め込んで登録し、
+    変更・削除された行の古いチャンクはインデックスから削除します。
+    rebuild が True の場合は、インデックスの全てのチャンク (dilect_vector や別のマシンから登録したものを含む) を削除してから、全ての行を登録し直します。
+    記録を導入する前に登録したインデックスでは、以前のチャンクと重複しないように1度だけ rebuild=True で実行してください。
+    テーブルは INGEST_BATCH_SIZE 行ずつ読み込んで分割・埋め込み・登録するため、大きなテーブルでも一定のメモリで登録できます。
+    SPLIT_WORKERS を2以上にした場合は、分割を複数のプロセスで並列に行います。
+    親の文章は、ローカルのインデックス (VECTOR_BACKEND=local) では ParentStore に1度だけ保存し、
+    Azure AI Search では検索するプロセスから ParentStore を読めないため、チャンクのメタデータ (split_source) に保持します。
+    """
     replace_name = table_name.replace("_", "-")
     index_name: str = "vector-" + replace_name
-    vector_store: AzureSearch = AzureSearch(
-        azure_search_endpoint=default_value.vector_store_address,
-        azure_search_key=default_value.vector_store_password,
-        index_name=index_name,
-        embedding_function=default_value.embeddings.embed_query,
-    )
-    
-    try:
-        print("データベースからデータの取得を開始します。")
-        sql_data = get_contexts(table_name)
-        print("データベースからの取得に成功しました。")
-    except Exception as e:
-        print(e)
-        return
-    
-    try:
-        print("データの分割を開始します。")
-        documents = split_data(sql_data)
-        print("データの分割に成功しました。")
-    except Exception as e:
-        print(e)
-        return
+    manifest = IndexManifest.load(index_name)
+    report = EmbeddingReport()
+    seen: Set[str] = set()
+    unchanged = 0
 
     try:
-        print("ベクトルデータの追加を開始します。")
-        vector_store.add_documents(documents=documents)
-        print("ベクトルデータの追加に成功しました。")
+        print("ベクトルデータの更新を開始します。")
+        if rebuild:
+            cleared = vector_backend.clear(index_name)
+            if not vector_backend.inline_parents:
+                parent_store.clear(index_name)
+            manifest.clear()
+            print(f"インデックス {index_name} の既存のチャンク {cleared}件を削除してから登録し直します。")
+        elif not manifest.exists():
+            # 記録のファイルがないだけでインデックスを削除しないように、警告のみを表示する
+            existing = vector_backend.count(index_name)
+            if existing:
+                print(f"警告: 登録の記録がありませんが、インデックス {index_name} には既に {existing}件のチャンクがあります。"
+                      f"以前の登録と重複する場合は add_vector({table_name!r}, rebuild=True) で登録し直してください。")
+        with split_executor() as executor:
+            for rows in batched(iter_data(table_name, page_size=INGEST_BATCH_SIZE), INGEST_BATCH_SIZE):
+                seen.update(source_id(row) for row in rows)
+                changed = [row for row in rows if manifest.is_changed(row)]
+                unchanged += len(rows) - len(changed)
+                if changed:
+                    update_rows(index_name, manifest, changed, report, executor)
+                    # 途中で失敗しても、登録済みの行を次回の実行で再登録しないように記録を保存する
+                    manifest.save()
+
+        removed = manifest.removed(seen)
+        stale_ids = [id for source in removed for id in manifest.chunks(source)]
+        if stale_ids:
+            vector_backend.delete_documents(index_name, stale_ids)
+        if not vector_backend.inline_parents:
+            parent_store.remove_stale(index_name, {source: [] for source in removed})
+        for source in removed:
+            manifest.remove(source)
+        manifest.save()
+        print(f"ベクトルデータの更新に成功しました。変更なし {unchanged}行, 削除 {len(removed)}行, 埋め込み: {report}")
     except Exception as e:
+        # 記録を保存していない行は、次回の実行で同じIDのチャンクを再登録する
         print(e)
-        return
-
-def dilect_vector(index_name, documents): # ベクトルdata追加関数
-    vector_store: AzureSearch = AzureSearch(
-        azure_search_endpoint=default_value.vector_store_address,
-        azure_search_key=default_value.vector_store_password,
-        index_name=index_name,
-        embedding_function=default_value.embeddings.embed_query,
-    )
-
-
-    vector_store.add_documents(documents=documents)
-
-
-
-
-
-def search_vector(
-    index_name: str,
-    search_word: str, 
-    k: int = 3
-    ) -> List[Document]: # ベクトル検索関数
-    index_name: str = index_name
-    vector_store: AzureSearch = AzureSearch(
-        azure_search_endpoint=default_value.vector_store_address,
-        azure_search_key=default_value.vector_store_password,
-        index_name=index_name,
-        embedding_function=default_value.embeddings.embed_query,
-    )
-    res = vector_store.similarity_search(query=search_word, search_type="hybrid", k=k)
-    return res
-
-
+    finally:
+        # 古い検索結果を使わないようにキャッシュを削除する
+        invalidate_search_caches(index_name)
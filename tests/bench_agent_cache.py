@@ -0,0 +1,38 @@
+import time
+import bench_env  # ダミーの環境変数と import パスを設定する (langchain・tech_agents より先に読み込む)
+
+from langchain.memory import ConversationBufferMemory
+from langchain_community.chat_models.fake import FakeListChatModel
+
+from tech_agents.template import default_value
+from tech_agents.template.agent_model import BaseToolAgent
+from tech_agents.template.memory import TurnMemory, use_memory
+from tech_agents.tools.procedure import LateNotificationAgent
+
+
+# BaseToolAgent の AgentExecutor キャッシュのマイクロベンチマーク
+# LLMは固定の応答を返すフェイクを使用し、エージェント構築のオーバーヘッドのみを計測する
+##### 実行: python tests/bench_agent_cache.py #####
+N = 200
+
+llm = FakeListChatModel(responses=["遅延届の申請ですね。"])
+memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+agent = LateNotificationAgent(llm=llm, memory=memory, chat_history=default_value.default_chat_history, verbose=False)
+
+
+def bench(label, invalidate):
+    with use_memory(TurnMemory(memory)):
+        start = time.perf_counter()
+        for _ in range(N):
+            if invalidate:
+                BaseToolAgent.invalidate_agent_cache()
+            agent.run("遅延届を出したいです")
+            memory.clear()
+        elapsed = time.perf_counter() - start
+    print(f'{label}: {elapsed / N * 1000:.3f} ms/turn ({N} turns)')
+    return elapsed
+
+
+cold = bench("cold (毎ターン initialize_agent)", invalidate=True)
+warm = bench("warm (キャッシュ済み AgentExecutor)", invalidate=False)
+print(f'speedup: {cold / warm:.1f}x')
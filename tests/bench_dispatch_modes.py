@@ -0,0 +1,109 @@
+import time
+from typing import Any, List, Optional
+import bench_env  # ダミーの環境変数と import パスを設定する (langchain・tech_agents より先に読み込む)
+
+from langchain.agents import Tool
+from langchain.chat_models.base import BaseChatModel
+from langchain.memory import ConversationBufferMemory, ReadOnlySharedMemory
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult, HumanMessage
+
+from tech_agents.template import default_value
+from tech_agents.template.agent_model import BaseDispatcherAgent
+from tech_agents.template.memory import TurnMemory
+
+
+# 入れ子のルーティング (2回のルーター呼び出し) と flatten=True のルーティング (1回のルーター呼び出し) の
+# エンドツーエンドのレイテンシを、LLMの応答時間を模したフェイクのLLMで比較する
+##### 実行: python tests/bench_dispatch_modes.py #####
+N = 20
+LATENCY = 0.2  # ルーター呼び出し1回あたりの応答時間 (秒)
+
+# 入力ごとの正解の振り分け先
+ROUTES = {
+    "奨学金の申請期限を教えて": ["search", "scholarship_agent"],
+    "Python機械学習の評価方法は？": ["search", "class_agent"],
+    "遅延届を出したいです": ["procedure", "late_notification"],
+    "公欠届を申請したい": ["procedure", "official_absence"],
+    "今日の運勢は？": ["horoscope"],
+}
+
+
+class FakeRouterLLM(BaseChatModel):
+    # プロンプトの候補の中から、正解の振り分け先を選んで返すフェイクのLLM
+    latency: float = LATENCY
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-router"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        candidates = [
+            line.split(":", 1)[0] for line in messages[0].content.splitlines() if ":" in line
+        ]
+        user_message = [message for message in messages if isinstance(message, HumanMessage)][-1].content
+        path = ROUTES.get(user_message, [])
+        answer = "DEFAULT"
+        if ".".join(path) in candidates:
+            answer = ".".join(path)
+        else:
+            for name in path:
+                if name in candidates:
+                    answer = name
+                    break
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
+
+
+def leaf(name):
+    return lambda input: f"{name}: {input}"
+
+
+class BenchSearchAgent(BaseDispatcherAgent):
+    def define_tools(self):
+        return [
+            Tool.from_function(func=leaf("school_agent"), name="school_agent", description="Kyoto Tech receptionist.", return_direct=True),
+            Tool.from_function(func=leaf("class_agent"), name="class_agent", description="Questions about classes.", return_direct=True),
+            Tool.from_function(func=leaf("scholarship_agent"), name="scholarship_agent", description="Questions about scholarships.", return_direct=True),
+        ]
+
+
+class BenchProcedureAgent(BaseDispatcherAgent):
+    def define_tools(self):
+        return [
+            Tool.from_function(func=leaf("late_notification"), name="late_notification", description="Late reports.", return_direct=True),
+            Tool.from_function(func=leaf("official_absence"), name="official_absence", description="Public absence reports.", return_direct=True),
+        ]
+
+
+class BenchMainAgent(BaseDispatcherAgent):
+    def define_tools(self):
+        self.search_agent = BenchSearchAgent(self.llm, self.readonly_memory, self.readonly_memory, self.chat_history, self.verbose)
+        self.procedure_agent = BenchProcedureAgent(self.llm, self.readonly_memory, self.readonly_memory, self.chat_history, self.verbose)
+        return [
+            Tool.from_function(func=self.search_agent.run, name="search", description="Searching and answering questions.", return_direct=True),
+            Tool.from_function(func=self.procedure_agent.run, name="procedure", description="Various procedures.", return_direct=True),
+            Tool.from_function(func=leaf("horoscope"), name="horoscope", description="Horoscopes.", return_direct=True),
+            Tool.from_function(func=leaf("DEFAULT"), name="DEFAULT", description="Non-professional conversation.", return_direct=True),
+        ]
+
+
+def bench(flatten):
+    llm = FakeRouterLLM()
+    memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+    readonly_memory = ReadOnlySharedMemory(memory=memory)
+    agent = BenchMainAgent(llm, memory, readonly_memory, default_value.default_chat_history, False, flatten)
+    turn = TurnMemory(memory, readonly_memory)
+
+    start = time.perf_counter()
+    for i in range(N):
+        message = list(ROUTES)[i % len(ROUTES)]
+        output = agent.run(message, turn=turn)
+        assert output.startswith(ROUTES[message][-1]), output
+    elapsed = time.perf_counter() - start
+    print(f'{"flatten" if flatten else "nested "}: {elapsed / N * 1000:.1f} ms/turn ({N} turns, router latency {LATENCY * 1000:.0f} ms)')
+    return elapsed
+
+
+nested = bench(flatten=False)
+flat = bench(flatten=True)
+print(f'speedup: {nested / flat:.2f}x')
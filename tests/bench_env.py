@@ -0,0 +1,21 @@
+import os, sys
+from dotenv import load_dotenv
+load_dotenv(override=True)
+
+# ベンチマークの共通の準備
+# tests/ のベンチマークのスクリプトの先頭で import bench_env してから、langchain や tech_agents を読み込んでください。
+
+# ベンチマークはAzureに接続しないため、未設定の環境変数にはダミー値を入れる
+for key, value in {
+    "OPENAI_API_VERSION": "2023-12-01-preview",
+    "DEPLOYMENT_GPT35_NAME": "dummy",
+    "DEPLOYMENT_EMBEDDINGS_NAME": "dummy",
+    "AZURE_OPENAI_ENDPOINT": "https://example.invalid",
+    "AZURE_OPENAI_API_KEY": "dummy",
+    "AZURE_SEARCH_ENDPOINT": "https://example.invalid",
+    "AZURE_SEARCH_KEY": "dummy",
+}.items():
+    os.environ.setdefault(key, value)
+
+# リポジトリのルートから tech_agents を読み込めるようにする
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
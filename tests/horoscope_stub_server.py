@@ -0,0 +1,75 @@
+import argparse
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# 占いのAPI (api.jugemkey.jp) のスタブサーバー
+# 実際のAPIと同じ形式の占い結果を返し、遅延やエラーを再現できます。
+##### 実行: python tests/horoscope_stub_server.py --port 8000 --fail-rate 0.3 #####
+##### 接続: HOROSCOPE_API_BASE=http://localhost:8000 を設定してエージェントを起動してください #####
+
+SIGNS = ['牡羊座', '牡牛座', '双子座', '蟹座', '獅子座', '乙女座', '天秤座', '蠍座', '射手座', '山羊座', '水瓶座', '魚座']
+ITEMS = ['ハンカチ', '手帳', '観葉植物', 'マグカップ', 'イヤホン', '腕時計']
+COLORS = ['赤', '青', '黄', '緑', '白', '紫']
+
+
+def horoscope_response(day: str) -> dict:  # 日付ごとに同じ結果になる占い結果を作成する関数
+    rng = random.Random(day)
+    ranks = rng.sample(range(1, 13), 12)
+    return {"horoscope": {day: [
+        {
+            "content": f"{day}の{sign}は、{rng.choice(['新しいことに挑戦すると良い日です。', '落ち着いて過ごすと良い日です。', '人との縁に恵まれる日です。'])}",
+            "item": rng.choice(ITEMS),
+            "money": rng.randint(1, 5),
+            "total": rng.randint(1, 5),
+            "job": rng.randint(1, 5),
+            "color": rng.choice(COLORS),
+            "day": day,
+            "love": rng.randint(1, 5),
+            "rank": rank,
+            "sign": sign,
+        }
+        for sign, rank in zip(SIGNS, ranks)
+    ]}}
+
+
+class HoroscopeHandler(BaseHTTPRequestHandler):
+    fail_rate = 0.0
+    delay = 0.0
+    requests = 0
+
+    def do_GET(self):
+        HoroscopeHandler.requests += 1
+        time.sleep(self.delay)
+        match = re.search(r"(\d{4}/\d{2}/\d{2})/?$", self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        if random.random() < self.fail_rate:
+            self.send_error(503)
+            return
+        body = json.dumps(horoscope_response(match.group(1)), ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print(f"[{HoroscopeHandler.requests}] {self.address_string()} {format % args}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="503 を返す割合 (0〜1)")
+    parser.add_argument("--delay", type=float, default=0.0, help="応答までの遅延 (秒)")
+    args = parser.parse_args()
+    HoroscopeHandler.fail_rate = args.fail_rate
+    HoroscopeHandler.delay = args.delay
+    server = ThreadingHTTPServer(("localhost", args.port), HoroscopeHandler)
+    print(f"http://localhost:{args.port} で待機しています。")
+    server.serve_forever()
@@ -22,6 +22,10 @@ from langchain_core.documents import Document
 # }
 # school_db.insert_data(table_name='class_data', data='pythonのテストデータです', metadata=metadata)
 
+# データ一括挿入 school_db.insert_many(テーブル名, (データ, メタデータ) の組のイテラブル)
+# report = school_db.insert_many('scholarship_data', ((doc.page_content, doc.metadata) for doc in pages))
+# print(report)
+
 # scholarship_dataの例
 # loader = PyPDFLoader("2023_taiyo_syougakukin_shiori.pdf")
 # pages = loader.load_and_split()
@@ -72,6 +76,9 @@ from langchain_core.documents import Document
 
 # ベクターストアの操作関数
 # ベクターストア作成 vector.add_vector(作成したいSQLDBのテーブル名)
+# SPLIT_WORKERS を2以上にする場合は、Windows・macOS では if __name__ == "__main__": の中で呼び出してください
+# 差分の記録を導入する前に作成したインデックスは、1度だけ rebuild=True で登録し直してください
+# vector.add_vector("class_data", rebuild=True)
 # vector.add_vector("class_data")
 # vector.add_vector("scholarship_data")
 